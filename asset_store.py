@@ -0,0 +1,87 @@
+import hashlib
+
+import numpy as np
+import torch as t
+
+
+
+###########################################################################################
+###########################################################################################
+###### Content-Addressed Sprite Store
+
+class AssetStore:
+    ''' Registry of sprite images keyed by content hash, so each distinct image is held and uploaded once.
+
+        States refer to sprites by integer asset id instead of carrying their own decoded images:
+            (asset_ids, img_sizes, tree, locs_rel, locs_abs, depths)
+        resolve() / resolve_device() turn the ids back into the image tuple the renderers take, without copying
+        pixels; the same id always resolves to the same array or device tensor.
+    '''
+
+    def __init__(self):
+        self.ids = dict()
+        self.assets = list()
+        self.device_assets = dict()
+
+    def __len__(self):
+        return len(self.assets)
+
+    def __getitem__(self, asset_id):
+        return self.assets[asset_id]
+
+    @staticmethod
+    def digest(img):
+        img = np.ascontiguousarray(img)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str((img.shape, img.dtype.str)).encode())
+        h.update(img.data)
+        return h.digest()
+
+    def add(self, img):
+        ## returns the id of img, registering it if no identical image is stored yet
+        key = self.digest(img)
+        asset_id = self.ids.get(key)
+        if asset_id is None:
+            asset_id = len(self.assets)
+            self.ids[key] = asset_id
+            self.assets.append(np.ascontiguousarray(img))
+        return asset_id
+
+    def sizes(self, asset_ids):
+        return np.array([self.assets[i].shape[:2] for i in asset_ids], dtype=np.int32)
+
+    def resolve(self, asset_ids):
+        return tuple( self.assets[i] for i in asset_ids )
+
+    def to_device(self, device='cuda'):
+        ## uploads only assets added since the last call for this device
+        on_device = self.device_assets.setdefault(device, list())
+        for img in self.assets[len(on_device):]:
+            on_device.append(t.from_numpy(img).to(device))
+        return on_device
+
+    def resolve_device(self, asset_ids, device='cuda'):
+        on_device = self.device_assets.get(device)
+        if on_device is None or len(on_device) < len(self.assets): on_device = self.to_device(device)
+        return tuple( on_device[i] for i in asset_ids )
+
+    def save(self, path):
+        np.savez(path, *self.assets)
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        with np.load(path) as f:
+            for i in range(len(f.files)):
+                store.add(f['arr_%i' % i])
+        return store
+
+
+def resolve_state(state, store, device=None):
+    ## legacy states carry their own image tuple; id states get theirs from the store
+    if store is None or isinstance(state[0], tuple): return state
+
+    asset_ids = state[0].tolist()
+    if device is None: imgs = store.resolve(asset_ids)
+    else: imgs = store.resolve_device(asset_ids, device)
+    return tuple( [imgs, *state[1:]] )
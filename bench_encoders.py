@@ -0,0 +1,98 @@
+import argparse
+import time
+
+import numpy as np
+
+from render_cpu.render_cpu import render_batch, FRAME_SIZE
+from encoders import ENCODERS, available_encoders, get_encoder
+
+
+
+###########################################################################################
+###########################################################################################
+###### Encoder Benchmark
+## Renders synthetic states with render_cpu, then encodes every frame with every available backend at a few qualities,
+## reporting encode time and output size. Pipe to bench_output.txt to keep a run.
+
+QUALITIES = {
+    'jpeg': [50, 75, 95],
+    'turbojpeg': [50, 75, 95],
+    'jpeg_strips': [50, 75, 95],
+    'webp': [50, 80],
+    'png': [0, 1, 6],
+    'raw': [None],
+    'lz4': [0, 9],
+}
+
+def synth_sprite(rng, size=100):
+    ## gradient, a few flat discs and some noise: smooth and busy regions, like the photo sprites in gen_test_data
+    y, x = np.mgrid[0:size, 0:size]
+    c0, c1 = rng.integers(0, 256, size=(2, 3))
+    sprite = c0 + (c1 - c0) * ((x + y) / (2 * size - 2))[..., None]
+
+    for _ in range(3):
+        cy, cx, r = rng.integers(0, size, size=3) // [1, 1, 3]
+        sprite[(y - cy)**2 + (x - cx)**2 < r**2] = rng.integers(0, 256, size=3)
+
+    sprite += rng.normal(0, 8, size=sprite.shape)
+    return np.clip(sprite, 0, 255).astype(np.uint8)
+
+def build_synth_state(rng, n_obj=21):
+    ## same layout as gen_test_data.build_test_state: a root, 4 children, and 4 grandchildren under each child
+    imgs = tuple(synth_sprite(rng) for _ in range(n_obj))
+    img_sizes = np.array([img.shape[:2] for img in imgs], dtype=np.int32)
+
+    parents = np.full(n_obj, -1, dtype=np.int32)
+    parents[1:5] = 0
+    parents[5:] = np.repeat(np.arange(1, 5, dtype=np.int32), 4)
+
+    locs_rel = np.stack([rng.integers(0, 501, size=n_obj), rng.integers(0, 901, size=n_obj)], axis=1).astype(np.int32)
+    locs_rel[0] = 0
+    locs_abs = np.zeros_like(locs_rel)
+    depths = np.arange(n_obj, dtype=np.int32)
+
+    return imgs,img_sizes,parents,locs_rel,locs_abs,depths
+
+def bench_encoder(encoder, frames, n_warmup=2):
+    for frame in frames[:n_warmup]: encoder(frame)
+
+    times, sizes = list(), list()
+    for frame in frames:
+        start = time.perf_counter()
+        message = encoder(frame)
+        times.append(time.perf_counter() - start)
+        sizes.append(0 if message is None else len(message))
+
+    return np.array(times), np.array(sizes)
+
+def run_bench(n_frames=30, encoders=None, seed=0):
+    print('rendering', n_frames, 'frames with render_cpu')
+    rng = np.random.default_rng(seed)
+    states = [build_synth_state(rng) for _ in range(n_frames)]
+    frames = render_batch(states, frame_size=FRAME_SIZE)
+    raw_bytes = frames[0].nbytes
+
+    if encoders is None: encoders = available_encoders()
+    missing = [name for name in ENCODERS if name not in available_encoders()]
+    if missing: print('not installed, skipping:', ', '.join(missing))
+
+    print('%-12s %7s %10s %10s %10s %9s %8s' % ('encoder', 'quality', 'mean ms', 'p95 ms', 'mean KB', 'ratio', 'fps'))
+    for name in encoders:
+        for quality in QUALITIES[name]:
+            encoder = get_encoder(name, quality)
+            times, sizes = bench_encoder(encoder, frames)
+
+            print('%-12s %7s %10.2f %10.2f %10.1f %9.1f %8.1f' % (
+                name, encoder.quality, times.mean() * 1e3, np.percentile(times, 95) * 1e3,
+                sizes.mean() / 1024, raw_bytes / max(sizes.mean(), 1), 1 / times.mean(),
+            ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark frame encoder backends on render_cpu frames')
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--encoders', nargs='*', default=None, help='subset of: ' + ' '.join(ENCODERS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run_bench(args.frames, args.encoders, args.seed)
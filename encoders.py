@@ -0,0 +1,318 @@
+import concurrent.futures
+import os
+
+import cv2
+import numpy as np
+
+try: from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError: TurboJPEG = None
+
+try: import lz4.frame as lz4_frame
+except ImportError: lz4_frame = None
+
+
+
+###########################################################################################
+###########################################################################################
+###### Frame Encoders
+## Every encoder is a callable taking a uint8 RGB frame (H x W x 3) and returning the encoded bytes, or None on
+## failure, so it plugs straight into FrameHub.encode. Encoders with equal keys produce identical output; the hub
+## caches one encode per frame per key, shared by every connection that asked for it.
+## Encoded output is any bytes-like object, usually a memoryview of the encoder's own buffer: it is copied once, when
+## a stream joins it with its framing, and never modified after.
+
+def blob_view(blob):
+    ## flat memoryview of a cv2.imencode result, without copying it into bytes
+    return blob.reshape(-1).data
+
+class FrameEncoder:
+    name = None
+    content_type = 'application/octet-stream'
+    default_quality = None
+
+    ## quality trades size for fidelity; false for lossless backends, whose quality is a speed setting
+    lossy = False
+
+    def __init__(self, quality=None):
+        self.quality = self.default_quality if quality is None else int(quality)
+
+    @property
+    def key(self):
+        return (self.name, self.quality)
+
+    def encode(self, frame):
+        raise NotImplementedError
+
+    def out_size(self, frame_size):
+        ## (h, w) of the encoded image for a frame of frame_size
+        return tuple(frame_size[:2])
+
+    def __call__(self, frame):
+        try:
+            return self.encode(frame)
+        except Exception as e:
+            print(type(self).__name__ + ': on encode, caught exception', type(e), ' : ', e)
+            return None
+
+
+class CvJpegEncoder(FrameEncoder):
+    name = 'jpeg'
+    content_type = 'image/jpeg'
+    default_quality = 95
+    lossy = True
+
+    def encode(self, frame):
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        success, blob = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if success: return blob_view(blob)
+
+
+## worker pool shared by all strip encoders; cv2.imencode releases the GIL
+strip_exec = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='jpeg_strip')
+
+def jpeg_scan(jpg):
+    ## offsets of the SOF header and the SOS segment, and the end of the SOS header (start of entropy-coded data)
+    sof = None
+    i = 2
+    while i + 4 <= len(jpg):
+        if jpg[i] != 0xFF: raise ValueError('bad jpeg marker at %i' % i)
+        code = jpg[i+1]
+        length = int.from_bytes(jpg[i+2:i+4], 'big')
+
+        if code == 0xC0 or code == 0xC1: sof = i
+        elif code == 0xDA: return sof, i, i + 2 + length
+        elif 0xC2 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC): raise ValueError('only baseline jpeg strips can be joined')
+        elif code == 0xDD: raise ValueError('strip already has restart markers')
+        i += 2 + length
+
+    raise ValueError('no SOS segment')
+
+def mcu_size(jpg, sof):
+    ## (h, w) of one MCU, from the component sampling factors in the SOF header
+    n_comp = jpg[sof + 9]
+    factors = [ jpg[sof + 10 + 3 * c + 1] for c in range(n_comp) ]
+    return 8 * max(f & 0x0F for f in factors), 8 * max(f >> 4 for f in factors)
+
+def join_jpeg_strips(strips, height):
+    ''' Joins baseline JPEGs of consecutive horizontal strips (same width, quality and tables; every strip but the
+        last a whole number of MCU rows high) into one JPEG of the given height.
+
+        The scan data of each strip is byte-aligned and starts with zeroed DC predictors, which is exactly what a
+        restart marker gives a decoder, so the strips are concatenated with RST0..RST7 between them and a DRI segment
+        setting the restart interval to one strip's worth of MCUs.
+    '''
+    sof, sos, _ = jpeg_scan(strips[0])
+    mcu_h, mcu_w = mcu_size(strips[0], sof)
+
+    strip_h = int.from_bytes(strips[0][sof+5:sof+7], 'big')
+    width = int.from_bytes(strips[0][sof+7:sof+9], 'big')
+    if strip_h % mcu_h: raise ValueError('strip height is not a whole number of MCU rows')
+
+    interval = (strip_h // mcu_h) * ((width + mcu_w - 1) // mcu_w)
+    if interval > 0xFFFF: raise ValueError('restart interval too large; use more strips')
+
+    head = bytearray(strips[0][:sos])
+    head[sof+5:sof+7] = height.to_bytes(2, 'big')
+
+    parts = [ bytes(head), b'\xff\xdd\x00\x04' + interval.to_bytes(2, 'big'), strips[0][sos:-2] ]
+    for n, strip in enumerate(strips[1:]):
+        _, _, data = jpeg_scan(strip)
+        parts.append( bytes([0xFF, 0xD0 + n % 8]) )
+        parts.append( strip[data:-2] )
+    parts.append(b'\xff\xd9')
+
+    return b''.join(parts)
+
+
+class StripJpegEncoder(FrameEncoder):
+    ''' JPEG encoded as horizontal strips in parallel, joined into one standard JPEG with restart markers.
+        Cuts per-frame encode latency on idle cores; output is a little larger than a single-pass encode.
+    '''
+    name = 'jpeg_strips'
+    content_type = 'image/jpeg'
+    default_quality = 95
+    lossy = True
+
+    ## strip heights are rounded to this, a multiple of any baseline MCU height
+    STRIP_ALIGN = 16
+
+    def __init__(self, quality=None, n_strips=None):
+        super().__init__(quality)
+        self.n_strips = os.cpu_count() if n_strips is None else n_strips
+
+    def encode_strip(self, strip):
+        success, blob = cv2.imencode('.jpg', strip, [cv2.IMWRITE_JPEG_QUALITY, self.quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+        if not success: raise ValueError('cv2.imencode failed on strip')
+        return blob_view(blob)
+
+    def encode(self, frame):
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        height = frame.shape[0]
+
+        strip_h = -(-height // self.n_strips)
+        strip_h = -(-strip_h // self.STRIP_ALIGN) * self.STRIP_ALIGN
+        strips = [ frame[y:y+strip_h] for y in range(0, height, strip_h) ]
+        if len(strips) == 1: return self.encode_strip(frame)
+
+        blobs = list(strip_exec.map(self.encode_strip, strips))
+        try:
+            return join_jpeg_strips(blobs, height)
+        except ValueError as e:
+            print('StripJpegEncoder: cannot join strips, encoding whole frame:', e)
+            return self.encode_strip(frame)
+
+
+class TurboJpegEncoder(FrameEncoder):
+    ## libjpeg-turbo through PyTurboJPEG; takes RGB directly, no channel swap
+    name = 'turbojpeg'
+    content_type = 'image/jpeg'
+    default_quality = 95
+    lossy = True
+
+    def __init__(self, quality=None):
+        super().__init__(quality)
+        self.jpeg = TurboJPEG()
+
+    def encode(self, frame):
+        return self.jpeg.encode(frame, quality=self.quality, pixel_format=TJPF_RGB)
+
+
+class WebpEncoder(FrameEncoder):
+    name = 'webp'
+    content_type = 'image/webp'
+    default_quality = 80
+    lossy = True
+
+    def encode(self, frame):
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        success, blob = cv2.imencode('.webp', frame, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+        if success: return blob_view(blob)
+
+
+class PngEncoder(FrameEncoder):
+    ## lossless; quality is the zlib compression level, 0 (fastest) to 9
+    name = 'png'
+    content_type = 'image/png'
+    default_quality = 1
+
+    def encode(self, frame):
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        success, blob = cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, self.quality])
+        if success: return blob_view(blob)
+
+
+class RawEncoder(FrameEncoder):
+    ## uncompressed RGB24 rows, for loopback clients that know the frame size
+    name = 'raw'
+    content_type = 'application/x-rgb24'
+
+    def encode(self, frame):
+        ## hub frames are never written after publish, so a view of the frame is safe to hand out
+        return np.ascontiguousarray(frame).reshape(-1).data
+
+
+class Lz4Encoder(FrameEncoder):
+    ## lossless LZ4 frame of the raw RGB24 rows; quality is the lz4 compression level, 0 (fastest) to 16
+    name = 'lz4'
+    content_type = 'application/x-rgb24-lz4'
+    default_quality = 0
+
+    def encode(self, frame):
+        return lz4_frame.compress(np.ascontiguousarray(frame), compression_level=self.quality)
+
+
+class ScaledEncoder:
+    ## downscales the frame before handing it to an inner encoder
+    def __init__(self, encoder, scale):
+        self.encoder = encoder
+        self.scale = scale
+
+    @property
+    def name(self): return self.encoder.name
+    @property
+    def quality(self): return self.encoder.quality
+    @property
+    def lossy(self): return self.encoder.lossy
+    @property
+    def content_type(self): return self.encoder.content_type
+
+    @property
+    def key(self):
+        return (*self.encoder.key, self.scale)
+
+    def out_size(self, frame_size):
+        return ( max(1, round(frame_size[0] * self.scale)), max(1, round(frame_size[1] * self.scale)) )
+
+    def __call__(self, frame):
+        try:
+            h, w = self.out_size(frame.shape)
+            frame = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+        except Exception as e:
+            print('ScaledEncoder: on cv2.resize, caught exception', type(e), ' : ', e)
+            return None
+        return self.encoder(frame)
+
+
+class ViewportEncoder:
+    ## crops a region of interest (y0, x0, y1, x1) out of the frame, then resizes it to size (h, w) for an inner encoder
+    def __init__(self, encoder, size, roi=None):
+        self.encoder = encoder
+        self.size = tuple(size)
+        self.roi = None if roi is None else tuple(roi)
+
+    @property
+    def name(self): return self.encoder.name
+    @property
+    def quality(self): return self.encoder.quality
+    @property
+    def lossy(self): return self.encoder.lossy
+    @property
+    def content_type(self): return self.encoder.content_type
+
+    @property
+    def key(self):
+        return (*self.encoder.key, 'view', self.size, self.roi)
+
+    def out_size(self, frame_size):
+        return self.size
+
+    def __call__(self, frame):
+        try:
+            if self.roi is not None:
+                y0, x0, y1, x1 = self.roi
+                frame = frame[y0:y1, x0:x1]
+            if frame.shape[:2] != self.size:
+                frame = cv2.resize(frame, (self.size[1], self.size[0]), interpolation=cv2.INTER_AREA)
+        except Exception as e:
+            print('ViewportEncoder: on crop and resize, caught exception', type(e), ' : ', e)
+            return None
+        return self.encoder(frame)
+
+
+ENCODERS = {enc.name: enc for enc in [CvJpegEncoder, TurboJpegEncoder, WebpEncoder, PngEncoder, RawEncoder, Lz4Encoder, StripJpegEncoder]}
+
+def available_encoders():
+    ## names of encoders whose optional dependency is installed
+    names = list(ENCODERS)
+    if TurboJPEG is None: names.remove('turbojpeg')
+    if lz4_frame is None: names.remove('lz4')
+    return names
+
+def encoding_id(name):
+    ## stable small integer per backend, for binary frame headers
+    return list(ENCODERS).index(name)
+
+_encoders = dict()
+
+def get_encoder(name, quality=None, scale=1.0):
+    ## shared instance per (name, quality, scale), so every stream asking for the same encoding hits the same cache key
+    if name not in available_encoders(): raise ValueError('unknown or unavailable encoder: ' + str(name))
+
+    cls = ENCODERS[name]
+    key = (name, cls.default_quality if quality is None else int(quality))
+    if key not in _encoders: _encoders[key] = cls(quality)
+    if scale == 1.0: return _encoders[key]
+
+    scaled_key = (*key, scale)
+    if scaled_key not in _encoders: _encoders[scaled_key] = ScaledEncoder(_encoders[key], scale)
+    return _encoders[scaled_key]
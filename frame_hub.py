@@ -0,0 +1,181 @@
+import concurrent.futures
+import functools
+import time
+
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+
+from frame_ring import META_DIRTY, META_T_RENDER, META_INPUT_ID, META_T_INPUT, META_T_RECV, META_T_STEP
+
+
+
+###########################################################################################
+###########################################################################################
+###### Server-Side Frame Hub
+
+def encode_timed(encoder, entry, key):
+    ## runs on the encoder worker; records when the encode finished
+    message = encoder(entry.frame)
+    entry.t_encoded[key] = time.time()
+    return message
+
+
+class HubFrame:
+    __slots__ = ('seq', 'frame', 'meta', 'encoded', 't_encoded')
+
+    def __init__(self, seq, frame, meta=None):
+        self.seq = seq
+        self.frame = frame
+        self.meta = meta
+
+        ## encode key -> future of encoded bytes; shared by every connection that wants this frame in that encoding
+        self.encoded = dict()
+        ## encode key -> wall-clock time its encode finished
+        self.t_encoded = dict()
+
+    @property
+    def t_render(self):
+        ## wall-clock time the agent published the frame
+        if self.meta is None: return 0.0
+        return self.meta[META_T_RENDER] / 1e6
+
+    @property
+    def trace(self):
+        ## (input_id, t_input, t_recv, t_step) of the last input this frame reflects; see frame_ring.META_INPUT_ID
+        if self.meta is None: return (0, 0.0, 0.0, 0.0)
+        return ( int(self.meta[META_INPUT_ID]), self.meta[META_T_INPUT] / 1e6, self.meta[META_T_RECV] / 1e6, self.meta[META_T_STEP] / 1e6 )
+
+    @property
+    def dirty(self):
+        ## (y0,x0,y1,x1) changed since frame seq-1
+        if self.meta is None: return (0, 0, *self.frame.shape[:2])
+        return tuple( int(v) for v in self.meta[META_DIRTY] )
+
+    def dirty_since(self, seq):
+        ## (y0,x0,y1,x1) changed since frame seq, as seen by a stream whose last frame was seq. Only the step from
+        ## seq-1 is recorded, so a stream that skipped frames (or has none yet) gets the whole frame
+        if seq != self.seq - 1: return (0, 0, *self.frame.shape[:2])
+        return self.dirty
+
+
+class StreamStats:
+    ## delivery counters for one stream; dropped counts frames published after the stream joined that it never got
+    __slots__ = ('kind', 'peer', 'sent', 'dropped', 'started')
+
+    def __init__(self, kind, peer):
+        self.kind = kind
+        self.peer = peer
+        self.sent = 0
+        self.dropped = 0
+        self.started = time.time()
+
+    def count(self, cursor, seq):
+        ## cursor is the last seq this stream delivered (0 before its first frame), seq the one it delivers now
+        if cursor > 0 and seq > cursor + 1: self.dropped += seq - cursor - 1
+        self.sent += 1
+
+    def as_dict(self):
+        return dict(kind=self.kind, peer=self.peer, sent=self.sent, dropped=self.dropped, started=self.started)
+
+
+class FrameHub:
+    ''' Single reader of the shared frame ring in the server process, fanning frames out to every stream.
+
+        One pump coroutine pulls the newest frame out of the ring and publishes it here with its sequence number.
+        Streams keep their own cursor and await next(cursor); every subscriber is woken on every publish, so open
+        connections no longer compete for frames. Delivery is latest-frame-wins: a stream that is slower than the
+        agent gets the newest frame and skips stale ones, so its latency stays bounded. Skipped frames are counted
+        per stream (see subscribe and stats).
+
+        Encoded bytes are cached on each HubFrame by encode key. The first request for a key schedules the encode
+        on the hub's encoder worker and every other request awaits the same future, so N viewers cost one encode.
+        The default encoding is started as soon as a frame is published, but only while some stream asked for it on
+        the previous frame; viewport and adaptive-level streams use other keys and would leave it unread.
+    '''
+
+    def __init__(self, frame_ring, encoder, n_encoders=1):
+        self.frame_ring = frame_ring
+        self.encoder = encoder
+        self.latest = None
+        self.cond = Condition()
+
+        self.streams = set()
+        ## frames the ring held that the hub itself never read, because a newer one was already there
+        self.ring_dropped = 0
+
+        ## the ring wait blocks on a multiprocessing Condition; keep it off the IOLoop thread
+        self.exec = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='frame_hub')
+        self.encode_exec = concurrent.futures.ThreadPoolExecutor(max_workers=n_encoders, thread_name_prefix='frame_encode')
+        self.running = False
+        ## newest seq a stream asked for in the default encoding
+        self.default_seq = 0
+
+    @property
+    def latest_seq(self):
+        if self.latest is None: return 0
+        return self.latest.seq
+
+    def start(self):
+        self.running = True
+        IOLoop.current().spawn_callback(self._pump)
+
+    def stop(self):
+        self.running = False
+
+    async def _pump(self):
+        ioloop = IOLoop.current()
+        cursor = max(0, self.frame_ring.latest_seq() - 1)
+
+        while self.running:
+            try:
+                seq, frame, meta = await ioloop.run_in_executor(self.exec, functools.partial(self.frame_ring.get_latest, cursor, 1.0))
+            except Exception as e:
+                print('FrameHub: on frame_ring.get_latest, caught exception', type(e), ' : ', e)
+                continue
+
+            if frame is None: continue
+            if self.latest is not None: self.ring_dropped += max(0, seq - cursor - 1)
+            cursor = seq
+            self.publish(seq, frame, meta)
+
+    def publish(self, seq, frame, meta=None):
+        entry = HubFrame(seq, frame, meta)
+        if self.latest is not None and self.default_seq >= self.latest.seq: self._encode(entry, self.encoder)
+
+        self.latest = entry
+        self.cond.notify_all()
+
+    def encode(self, entry, encoder=None):
+        ## returns an awaitable of entry.frame encoded by encoder (default: the hub's); runs at most once per (frame, encoder.key)
+        if encoder is None: encoder = self.encoder
+        if encoder.key == self.encoder.key: self.default_seq = max(self.default_seq, entry.seq)
+        return self._encode(entry, encoder)
+
+    def _encode(self, entry, encoder):
+        future = entry.encoded.get(encoder.key)
+        if future is None:
+            future = IOLoop.current().run_in_executor(self.encode_exec, functools.partial(encode_timed, encoder, entry, encoder.key))
+            entry.encoded[encoder.key] = future
+        return future
+
+    async def next(self, cursor):
+        ## returns the newest frame if it is newer than cursor; otherwise waits for the next publish
+        while self.latest_seq <= cursor:
+            await self.cond.wait()
+
+        return self.latest
+
+    def subscribe(self, kind, peer=None):
+        stats = StreamStats(kind, peer)
+        self.streams.add(stats)
+        return stats
+
+    def unsubscribe(self, stats):
+        self.streams.discard(stats)
+
+    def stats(self):
+        return dict(
+            latest_seq=self.latest_seq,
+            ring_dropped=self.ring_dropped,
+            streams=[stats.as_dict() for stats in self.streams],
+        )
@@ -0,0 +1,68 @@
+import time
+
+from tornado import gen
+
+
+
+###########################################################################################
+###########################################################################################
+###### Frame Pacing
+
+class FramePacer:
+    ''' Fixed-rate frame clock for the agent loop.
+
+        wait() returns at the start of each frame interval; frame_done() marks the end of that frame's work. A frame
+        whose work runs past the end of its interval is a missed deadline: it is counted, and the next frame starts
+        as soon as wait() is called instead of trying to catch up with a burst of frames.
+
+        Every report_interval seconds a line with the frame rate, missed deadlines and frame work times is printed.
+    '''
+
+    def __init__(self, fps=60.0, report_interval=5.0):
+        self.interval = 1.0 / fps
+        self.report_interval = report_interval
+
+        self.next_start = None
+        self.frame_start = None
+
+        self.frames = 0
+        self.missed = 0
+        self.work_total = 0.0
+        self.work_max = 0.0
+        self.report_start = time.perf_counter()
+
+    async def wait(self):
+        now = time.perf_counter()
+        if self.next_start is None or now >= self.next_start:
+            ## first frame, or the last one overran: start now and keep the cadence from here
+            self.next_start = now
+        else:
+            await gen.sleep(self.next_start - now)
+
+        self.frame_start = self.next_start
+        self.next_start += self.interval
+
+    def frame_done(self):
+        now = time.perf_counter()
+        work = now - self.frame_start
+
+        self.frames += 1
+        self.work_total += work
+        self.work_max = max(self.work_max, work)
+        if now > self.next_start: self.missed += 1
+
+        if now - self.report_start >= self.report_interval: self.report(now)
+
+    def report(self, now):
+        elapsed = now - self.report_start
+        print('frame pacer: %.1f fps (target %.1f), %i missed deadlines, work mean %.2f ms max %.2f ms' % (
+            self.frames / elapsed, 1.0 / self.interval, self.missed,
+            1e3 * self.work_total / max(self.frames, 1), 1e3 * self.work_max,
+        ))
+
+        self.frames = 0
+        self.missed = 0
+        self.work_total = 0.0
+        self.work_max = 0.0
+        self.report_start = now
+
@@ -0,0 +1,169 @@
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch.multiprocessing as mp
+
+
+## (y,x)
+FRAME_SIZE = (1080,1920)
+
+## columns of the per-slot metadata table
+META_SEQ = 0
+## region (y0,x0,y1,x1) that changed since the previous frame; the whole frame unless the renderer says otherwise
+META_DIRTY = slice(1, 5)
+## wall-clock time the frame was published, in microseconds since the epoch
+META_T_RENDER = 5
+## the last input the agent consumed before rendering the frame: its browser id, browser time, server receive time, and
+## when the agent took it (times in microseconds since the epoch); all 0 before the first input
+META_INPUT_ID = 6
+META_T_INPUT = 7
+META_T_RECV = 8
+META_T_STEP = 9
+N_META = 10
+
+## seq value marking a slot that is being written
+SEQ_WRITING = -1
+
+
+
+###########################################################################################
+###########################################################################################
+###### Shared-Memory Frame Ring
+
+class FrameRing:
+    ''' Fixed-size ring of preallocated framebuffers in shared memory, written by the agent and read by the server.
+
+        Layout of the shared block:
+            [ write_seq (int64) | meta (n_slots x N_META int64) | frames (n_slots x H x W x 3) ]
+
+        Frame n (n >= 1) lives in slot n % n_slots. The writer marks a slot with SEQ_WRITING while filling it and
+        stamps its seq when done; a reader copies a slot out and re-checks the stamp, so a frame overwritten mid-copy
+        is detected and dropped instead of being torn. A multiprocessing Condition is the only notify primitive;
+        no frame data passes through a manager process or a pipe.
+
+        Must be created in the parent before the agent and server processes are started; child processes re-attach
+        to the same block on unpickle.
+    '''
+
+    def __init__(self, frame_size=FRAME_SIZE, n_slots=4, dtype=np.uint8):
+        self.frame_size = tuple(frame_size)
+        self.n_slots = n_slots
+        self.dtype = np.dtype(dtype)
+
+        nbytes = self._n_header() * 8 + n_slots * self._frame_nbytes()
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.cond = mp.Condition()
+        self._owner = True
+
+        self._attach()
+        self.write_seq[0] = 0
+        self.meta.fill(0)
+
+    def _n_header(self):
+        return 1 + self.n_slots * N_META
+
+    def _frame_nbytes(self):
+        return int(np.prod(self.frame_size)) * 3 * self.dtype.itemsize
+
+    def _attach(self):
+        buf = self.shm.buf
+        n_header = self._n_header()
+
+        header = np.ndarray([n_header], dtype=np.int64, buffer=buf)
+        self.write_seq = header[0:1]
+        self.meta = header[1:].reshape(self.n_slots, N_META)
+
+        self.frames = np.ndarray([self.n_slots, *self.frame_size, 3], dtype=self.dtype, buffer=buf, offset=n_header * 8)
+
+    ## pickled into child processes by shm name; numpy views are rebuilt on the other side
+    def __getstate__(self):
+        return dict(name=self.shm.name, frame_size=self.frame_size, n_slots=self.n_slots, dtype=self.dtype.str, cond=self.cond)
+
+    def __setstate__(self, state):
+        self.frame_size = state['frame_size']
+        self.n_slots = state['n_slots']
+        self.dtype = np.dtype(state['dtype'])
+        self.cond = state['cond']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._attach()
+
+    def close(self):
+        ## views must be released before the mapping can be closed
+        self.write_seq = self.meta = self.frames = None
+        try: self.shm.close()
+        except Exception as e: print('FrameRing: on shm.close, caught exception', type(e), ' : ', e)
+
+        if self._owner:
+            try: self.shm.unlink()
+            except FileNotFoundError: pass
+
+
+    ###### Writer side (one writer)
+
+    def claim(self):
+        ## returns the next seq and the slot to render into; the slot is not visible to readers until publish(seq)
+        seq = int(self.write_seq[0]) + 1
+        slot = seq % self.n_slots
+        self.meta[slot, META_SEQ] = SEQ_WRITING
+        return seq, self.frames[slot]
+
+    def publish(self, seq, dirty=None, t_render=None, trace=None):
+        ## trace: (input_id, t_input, t_recv, t_step) of the last input the frame reflects, times in unix seconds
+        slot = seq % self.n_slots
+        if dirty is None: dirty = (0, 0, *self.frame_size)
+        if t_render is None: t_render = time.time()
+        self.meta[slot, META_DIRTY] = dirty
+        self.meta[slot, META_T_RENDER] = int(t_render * 1e6)
+
+        input_id, t_input, t_recv, t_step = (0, 0.0, 0.0, 0.0) if trace is None else trace
+        self.meta[slot, META_INPUT_ID] = input_id
+        self.meta[slot, META_T_INPUT] = int(t_input * 1e6)
+        self.meta[slot, META_T_RECV] = int(t_recv * 1e6)
+        self.meta[slot, META_T_STEP] = int(t_step * 1e6)
+        self.meta[slot, META_SEQ] = seq
+        self.write_seq[0] = seq
+
+        with self.cond:
+            self.cond.notify_all()
+
+
+    ###### Reader side (any number of readers, each with its own cursor)
+
+    def latest_seq(self):
+        return int(self.write_seq[0])
+
+    def wait(self, cursor, timeout=None):
+        ## blocks until a frame newer than cursor is published; returns the latest seq, or None on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.latest_seq() <= cursor:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0: return None
+                self.cond.wait(remaining)
+
+        return self.latest_seq()
+
+    def read(self, seq, out=None):
+        ## copies frame seq and its metadata row out of the ring; returns (None, None) if it was overwritten before or during the copy
+        slot = seq % self.n_slots
+        if self.meta[slot, META_SEQ] != seq: return None, None
+
+        if out is None: out = np.empty([*self.frame_size, 3], dtype=self.dtype)
+        np.copyto(out, self.frames[slot])
+        meta = self.meta[slot].copy()
+
+        if self.meta[slot, META_SEQ] != seq: return None, None
+        return out, meta
+
+    def get_latest(self, cursor, timeout=None):
+        ## latest-frame-wins read: returns (seq, frame, meta) for the newest frame after cursor, skipping older ones,
+        ## or (cursor, None, None) on timeout
+        latest = self.wait(cursor, timeout)
+        if latest is None: return cursor, None, None
+
+        while True:
+            seq = self.latest_seq()
+            frame, meta = self.read(seq)
+            if frame is not None: return seq, frame, meta
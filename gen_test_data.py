@@ -3,7 +3,9 @@ import random
 import os
 import PIL.Image as Image
 import numpy as np
-from run_agent import to_gpu
+from run_agent import to_gpu, to_numpy_state, z_dtype
+from render_cpu.render_cpu import render_batch
+from asset_store import AssetStore, resolve_state
 
 
 
@@ -14,6 +16,7 @@ from run_agent import to_gpu
 ## (y,x)
 FRAME_SIZE = (1080,1920)
 IMG_DIR = os.path.join( os.path.split(__file__)[0], 'images' )
+DATA_DIR = '/home/chris/Documents/agent_interface/'
 
 def get_rand_image():
     name = random.choice(os.listdir(IMG_DIR))
@@ -35,7 +38,8 @@ def rand_pair():
 def to_tensor(states):
     for i,state in enumerate(states):
 
-        state_0 = tuple( [t.from_numpy(img) for img in state[0]] )
+        if isinstance(state[0], tuple): state_0 = tuple( [t.from_numpy(img) for img in state[0]] )
+        else: state_0 = t.from_numpy(state[0])
         others = tuple( [t.from_numpy(tem) for tem in state[1:]] )
         states[i] = tuple( [state_0, *others] )
     return states
@@ -44,7 +48,8 @@ def to_tensor(states):
 
 ##################################################################################################################
 #### Data Generators
-def build_test_state():
+def build_test_state(store=None):
+    ## with an AssetStore, the state holds int32 asset ids in place of its image tuple
 
     offs_locs_x = (0, 900)
     offs_locs_y = (0, 500)
@@ -52,6 +57,7 @@ def build_test_state():
 
     imgs = tuple(get_rand_image() for _ in range(n_obj))
     img_sizes = np.array([(img.shape[0],img.shape[1]) for img in imgs], dtype=np.int32)
+    if store is not None: imgs = np.array([store.add(img) for img in imgs], dtype=np.int32)
 
     ## row 0 is always tree root. Children always have higher id than parent.
     child_mat = np.zeros([n_obj,n_obj], dtype=np.uint8)
@@ -75,31 +81,41 @@ def build_test_state():
     return imgs,img_sizes,child_mat,locs_rel,locs_abs,depths
 
 def gen_states(n_states=10):
+    ## states reference sprites by asset id; the sprites themselves are saved once, to assets.npz
     print('generating states')
 
+    store = AssetStore()
     states = list()
     for i in range(n_states):
         if i%100==0: print('building state: ', i)
-        state = build_test_state()
+        state = build_test_state(store)
         states.append(state)
 
     states = to_tensor(states)
-    print('saving states')
-    t.save(states, '/home/chris/Documents/agent_interface/' + str(n_states) + '_small_states.list')
+    print('saving states and', len(store), 'assets')
+    t.save(states, DATA_DIR + str(n_states) + '_small_states.list')
+    store.save(DATA_DIR + 'assets.npz')
+
+def load_store():
+    path = DATA_DIR + 'assets.npz'
+    if os.path.exists(path): return AssetStore.load(path)
+    return None
 
 def gen_buffs(n_buffs=10):
     print("loading states from disk")
     states = t.load('/home/chris/Documents/agent_interface/' + str(n_buffs) + '_states.list')
     states = to_gpu(states)
+    store = load_store()
 
-    z_buffer = t.empty(FRAME_SIZE, dtype=t.int32).cuda()
-    f_buffer = t.empty([*FRAME_SIZE,3], dtype=t.int32).cuda()
+    z_buffer = t.empty(FRAME_SIZE, dtype=z_dtype(states)).cuda()
+    f_buffer = t.empty([*FRAME_SIZE,3], dtype=t.uint8).cuda()
     lock_buffer = t.empty(FRAME_SIZE, dtype=t.int32).cuda()
 
     buffs = list()
     for i,state in enumerate(states):
         if i%100==0: print('creating buff', i)
 
+        state = resolve_state(state, store, 'cuda')
         t.ops.render_op.render_kernel(*state, z_buffer, f_buffer, lock_buffer)
 
         f_buffer_cpu = f_buffer.cpu()
@@ -107,5 +123,16 @@ def gen_buffs(n_buffs=10):
 
     t.save(buffs, '/home/chris/Documents/agent_interface/'+str(n_buffs)+'_buffs.list')
 
+def gen_buffs_cpu(n_buffs=10):
+    ## same frames as gen_buffs, batch-rendered on cpu straight into a memory-mapped .npy file
+    print("loading states from disk")
+    states = t.load('/home/chris/Documents/agent_interface/' + str(n_buffs) + '_states.list')
+    states = to_numpy_state(states)
+    store = load_store()
+    states = [resolve_state(state, store) for state in states]
+
+    print('rendering', len(states), 'buffs')
+    render_batch(states, out_path='/home/chris/Documents/agent_interface/'+str(n_buffs)+'_buffs.npy', frame_size=FRAME_SIZE)
+
 if __name__ == "__main__":
     gen_states(600)
\ No newline at end of file
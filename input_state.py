@@ -0,0 +1,209 @@
+import collections
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+
+###########################################################################################
+###########################################################################################
+###### Shared-Memory Mouse Position Slot
+
+## one input as the agent sees it. kind 'm', 'c' or 'k'; args (x, y), (button,) or (key, shiftKey, ctrlKey, altKey);
+## t the browser time of the event and t_recv the time the server took it, unix seconds (t is 0 if the client sent none);
+## input_id the browser's id for the event, 0 if it sent none
+InputEvent = collections.namedtuple('InputEvent', 'kind args t input_id t_recv')
+
+## columns of the slot
+SLOT_VERSION = 0
+SLOT_X = 1
+SLOT_Y = 2
+## browser timestamp of the move, in microseconds since the epoch (0 if the client sent none)
+SLOT_T = 3
+SLOT_ID = 4
+## server receive time, in microseconds since the epoch
+SLOT_T_RECV = 5
+N_SLOT = 6
+
+## attempts MouseSlot.read makes while a write is in progress before it falls back to its last consistent read
+READ_RETRIES = 1000
+
+class MouseSlot:
+    ''' Latest mouse position in shared memory, written by the server and read by the agent.
+
+        Moves overwrite each other instead of queueing: the agent always sees the newest position and never has a
+        backlog to drain. The slot carries a version counter, doubled as a seqlock: the writer makes it odd while it
+        writes x and y and even again when done, so a reader retries rather than seeing a torn position, and
+        version // 2 counts the moves so far. A reader compares versions to tell whether the mouse moved since it
+        last looked.
+
+        One writer (the server's IOLoop thread). Like FrameRing, create it in the parent before the agent and server
+        processes are started; child processes re-attach on unpickle.
+    '''
+
+    def __init__(self):
+        self.shm = shared_memory.SharedMemory(create=True, size=N_SLOT * 8)
+        self._owner = True
+        self._attach()
+        self.slot.fill(0)
+
+    def _attach(self):
+        self.slot = np.ndarray([N_SLOT], dtype=np.int64, buffer=self.shm.buf)
+        ## this process's last consistent read, returned if the writer stays mid-write (e.g. it died there)
+        self.last_read = (0, InputEvent('m', (0, 0), 0.0, 0, 0.0))
+
+    def __getstate__(self):
+        return dict(name=self.shm.name)
+
+    def __setstate__(self, state):
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._attach()
+
+    def close(self):
+        self.slot = None
+        try: self.shm.close()
+        except Exception as e: print('MouseSlot: on shm.close, caught exception', type(e), ' : ', e)
+
+        if self._owner:
+            try: self.shm.unlink()
+            except FileNotFoundError: pass
+
+    def write(self, x, y, t=0.0, input_id=0):
+        t_recv = time.time()
+        version = int(self.slot[SLOT_VERSION])
+        self.slot[SLOT_VERSION] = version + 1
+        self.slot[SLOT_X] = x
+        self.slot[SLOT_Y] = y
+        self.slot[SLOT_T] = int(t * 1e6)
+        self.slot[SLOT_ID] = input_id
+        self.slot[SLOT_T_RECV] = int(t_recv * 1e6)
+        self.slot[SLOT_VERSION] = version + 2
+
+    def read(self, retries=READ_RETRIES):
+        ## returns (version, InputEvent of the newest move); version 0 means no move yet. A write takes microseconds, so
+        ## a reader that still finds one in progress after retries attempts, yielding between them, gives up and
+        ## returns its last consistent read, which reads as no new move
+        for _ in range(retries):
+            version = int(self.slot[SLOT_VERSION])
+            if not version & 1:
+                values = self.slot.tolist()
+                if int(self.slot[SLOT_VERSION]) == version:
+                    event = InputEvent('m', (values[SLOT_X], values[SLOT_Y]), values[SLOT_T] / 1e6, values[SLOT_ID], values[SLOT_T_RECV] / 1e6)
+                    self.last_read = (version // 2, event)
+                    return self.last_read
+            time.sleep(0)
+
+        return self.last_read
+
+
+
+###########################################################################################
+###########################################################################################
+###### Shared-Memory Input Event Ring
+
+## one fixed-size record per click or key event. t is the browser timestamp and t_recv the server receive time, in
+## microseconds since the epoch (t is 0 if the client sent none); id is the browser's input id, 0 if none;
+## key is the browser's KeyboardEvent.key, utf-8, truncated to fit
+INPUT_RECORD = np.dtype([('id', 'i8'), ('t', 'i8'), ('t_recv', 'i8'), ('kind', 'S1'), ('mods', 'u1'), ('button', 'i2'), ('key', 'S28')])
+MOD_SHIFT = 1
+MOD_CTRL = 2
+MOD_ALT = 4
+
+## counters ahead of the records: events written, events read
+RING_HEAD = 0
+RING_TAIL = 1
+N_COUNTERS = 2
+
+class InputRing:
+    ''' Single-producer single-consumer ring of INPUT_RECORD events in shared memory: clicks and keys, in order.
+
+        Layout of the shared block:
+            [ head (int64) | tail (int64) | records (n_records x INPUT_RECORD) ]
+
+        The server's IOLoop thread is the only writer: it fills the record at head % n_records and then advances
+        head. The agent is the only reader: it copies out everything between tail and head and then advances tail.
+        Each counter has one writer, so no lock is needed and a put is a few stores, cheap enough to do inline in a
+        request handler. A full ring drops the new event and counts it rather than blocking the IOLoop.
+
+        Create it in the parent before the agent and server processes are started, like FrameRing.
+    '''
+
+    def __init__(self, n_records=1024):
+        self.n_records = n_records
+        self.shm = shared_memory.SharedMemory(create=True, size=N_COUNTERS * 8 + n_records * INPUT_RECORD.itemsize)
+        self._owner = True
+        self.dropped = 0
+
+        self._attach()
+        self.counters.fill(0)
+
+    def _attach(self):
+        buf = self.shm.buf
+        self.counters = np.ndarray([N_COUNTERS], dtype=np.int64, buffer=buf)
+        self.records = np.ndarray([self.n_records], dtype=INPUT_RECORD, buffer=buf, offset=N_COUNTERS * 8)
+
+    def __getstate__(self):
+        return dict(name=self.shm.name, n_records=self.n_records)
+
+    def __setstate__(self, state):
+        self.n_records = state['n_records']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self.dropped = 0
+        self._attach()
+
+    def close(self):
+        self.counters = self.records = None
+        try: self.shm.close()
+        except Exception as e: print('InputRing: on shm.close, caught exception', type(e), ' : ', e)
+
+        if self._owner:
+            try: self.shm.unlink()
+            except FileNotFoundError: pass
+
+
+    ###### Writer side
+
+    def put(self, kind, button=0, key='', shiftKey=False, ctrlKey=False, altKey=False, t=0.0, input_id=0):
+        head = int(self.counters[RING_HEAD])
+        if head - int(self.counters[RING_TAIL]) >= self.n_records:
+            self.dropped += 1
+            print('InputRing: ring full, dropped event', kind, button, key, '; dropped so far:', self.dropped)
+            return False
+
+        mods = MOD_SHIFT * bool(shiftKey) | MOD_CTRL * bool(ctrlKey) | MOD_ALT * bool(altKey)
+        self.records[head % self.n_records] = (input_id, int(t * 1e6), int(time.time() * 1e6), kind.encode(), mods, button,
+                                               key.encode()[:INPUT_RECORD['key'].itemsize])
+        self.counters[RING_HEAD] = head + 1
+        return True
+
+    def put_click(self, button, t=0.0, input_id=0):
+        return self.put('c', button=button, t=t, input_id=input_id)
+
+    def put_key(self, key, shiftKey, ctrlKey, altKey, t=0.0, input_id=0):
+        return self.put('k', key=key, shiftKey=shiftKey, ctrlKey=ctrlKey, altKey=altKey, t=t, input_id=input_id)
+
+
+    ###### Reader side
+
+    def get_all(self):
+        ## every event written since the last call, oldest first, as InputEvents
+        tail = int(self.counters[RING_TAIL])
+        head = int(self.counters[RING_HEAD])
+        if head == tail: return []
+
+        records = self.records[np.arange(tail, head) % self.n_records]
+        self.counters[RING_TAIL] = head
+        return [ unpack_record(record) for record in records ]
+
+
+def unpack_record(record):
+    kind = record['kind'].decode()
+    if kind == 'c': args = (int(record['button']),)
+    else:
+        mods = int(record['mods'])
+        args = (record['key'].decode(errors='ignore'), bool(mods & MOD_SHIFT), bool(mods & MOD_CTRL), bool(mods & MOD_ALT))
+
+    return InputEvent(kind, args, int(record['t']) / 1e6, int(record['id']), int(record['t_recv']) / 1e6)
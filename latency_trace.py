@@ -0,0 +1,75 @@
+import collections
+
+import numpy as np
+
+
+
+###########################################################################################
+###########################################################################################
+###### Input-to-Photon Latency Tracing
+## Every input event gets an id and a timestamp in the browser. The server stamps when it took the event, the agent tags
+## each frame with the last input it consumed and when it took it, and the frame carries that trace to the browser along
+## with its render, encode and send times. When a frame shows an input of its own for the first time, the browser
+## reports the whole trace here, plus when the frame arrived and when it was drawn.
+##
+## Every browser time is Date.now(), so total (input to shown) is measured on the browser's wall clock alone and needs
+## no offset; it is off only if that clock is stepped while the input is in flight. The two stages that cross between
+## clocks are corrected by the browser's estimate of its offset from the server's clock (min of arrival - send), which
+## also absorbs the fastest network delay; treat them as approximate.
+
+## stage -> (start, end) trace fields; times in unix seconds. client_* are on the browser's clock, *_client are server
+## times moved onto it
+STAGES = collections.OrderedDict([
+    ('client_to_server', ('client_input', 't_recv_client')),
+    ('server_to_agent', ('t_recv', 't_step')),
+    ('agent_render', ('t_step', 't_render')),
+    ('encode', ('t_render', 't_encode')),
+    ('encode_to_send', ('t_encode', 't_send')),
+    ('server_to_client', ('t_send_client', 'client_arrive')),
+    ('decode_and_draw', ('client_arrive', 'client_shown')),
+    ('total', ('client_input', 'client_shown')),
+])
+
+PERCENTILES = (50, 95, 99)
+
+class LatencyTracker:
+    ''' Keeps the last max_samples latencies of every stage, in ms, from the traces browsers report. '''
+
+    def __init__(self, max_samples=2000):
+        self.samples = { stage: collections.deque(maxlen=max_samples) for stage in STAGES }
+        self.n_traces = 0
+
+    def add(self, trace):
+        ## trace: dict with t_input, t_recv, t_step, t_render, t_encode, t_send, t_arrive, t_shown and clock_offset;
+        ## t_input, t_arrive and t_shown are on the browser's clock
+        offset = float(trace.get('clock_offset') or 0.0)
+        times = dict(
+            client_input=float(trace['t_input']),
+            client_arrive=float(trace['t_arrive']),
+            client_shown=float(trace['t_shown']),
+        )
+        for field in ('t_recv', 't_step', 't_render', 't_encode', 't_send'):
+            times[field] = float(trace[field])
+
+        ## server times onto the browser's clock, for the stages that cross between them
+        for field in ('t_recv', 't_send'):
+            times[field + '_client'] = times[field] + offset
+
+        for stage, (start, end) in STAGES.items():
+            self.samples[stage].append(1e3 * (times[end] - times[start]))
+
+        self.n_traces += 1
+
+    def summary(self):
+        ## stage -> {n, mean, p50, p95, p99} in ms
+        summary = collections.OrderedDict()
+        for stage, samples in self.samples.items():
+            if not samples:
+                summary[stage] = dict(n=0)
+                continue
+
+            values = np.fromiter(samples, dtype=np.float64)
+            summary[stage] = dict(n=len(values), mean=float(values.mean()))
+            for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                summary[stage]['p%i' % p] = float(v)
+        return summary
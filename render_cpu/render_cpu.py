@@ -1,5 +1,21 @@
+import concurrent.futures
+import os
+
+import numpy as np
 from numba import njit, prange
 
+## value of an empty z_buffer pixel; every sprite depth must be below it. Fits an int16 z_buffer
+Z_MAX = 25555
+
+## (y,x)
+FRAME_SIZE = (1080,1920)
+
+def make_buffers(frame_size=FRAME_SIZE, max_depth=0):
+    ## compact buffers: uint8 RGB frame, and a 16-bit z_buffer unless some depth does not fit below Z_MAX
+    z_dtype = np.int16 if max_depth < Z_MAX else np.int32
+    z_buffer = np.empty(frame_size, dtype=z_dtype)
+    f_buffer = np.empty([*frame_size, 3], dtype=np.uint8)
+    return z_buffer, f_buffer
 
 
 ###########################################################################################
@@ -46,7 +62,7 @@ def render_state_parallel(imgs,child_mat,locs_rel,locs_abs,depths,z_buffer,f_buf
 
 @njit(parallel=True)
 def transform_and_render(imgs,img_sizes,child_mat,locs_rel,locs_abs,depths,z_buffer,f_buffer):
-    z_buffer.fill(25555)
+    z_buffer.fill(Z_MAX)
     f_buffer.fill(0)
 
     n_loops = len(imgs)
@@ -79,6 +95,362 @@ def transform_and_render(imgs,img_sizes,child_mat,locs_rel,locs_abs,depths,z_buf
 
 
 
+
+###########################################################################################
+###########################################################################################
+###### Sparse Object Tree
+## The tree can be given as a parent-id array (parents[i] == id of i's parent, -1 for a root), or as CSR children lists
+## (children of p are child_idx[child_ptr[p]:child_ptr[p+1]]). Both are O(n) in memory and transform, unlike child_mat.
+
+@njit
+def transform_locs(child_mat,locs_rel,locs_abs):
+
+    ## row gives parent id. Must visit and process sequentially
+    for row in range( child_mat.shape[0] ):
+        curr_offs = locs_abs[row]
+
+        for col in range( child_mat.shape[1] ):
+            if child_mat[row,col]:
+                locs_abs[col] = locs_rel[col] + curr_offs
+
+    return locs_abs
+
+def child_mat_to_parents(child_mat):
+    ## converter for states stored with a dense n x n child_mat
+    parents = np.full(child_mat.shape[0], -1, dtype=np.int32)
+    rows, cols = np.nonzero(child_mat)
+    parents[cols] = rows
+    return parents
+
+def state_to_sparse(state):
+    imgs,img_sizes,child_mat,locs_rel,locs_abs,depths = state
+    return imgs,img_sizes,child_mat_to_parents(child_mat),locs_rel,locs_abs,depths
+
+@njit
+def parents_to_csr(parents):
+    n_obj = parents.shape[0]
+
+    child_ptr = np.zeros(n_obj + 1, dtype=np.int32)
+    for obj in range(n_obj):
+        if parents[obj] >= 0: child_ptr[parents[obj] + 1] += 1
+    for obj in range(n_obj):
+        child_ptr[obj + 1] += child_ptr[obj]
+
+    child_idx = np.empty(child_ptr[n_obj], dtype=np.int32)
+    fill = child_ptr[:-1].copy()
+    for obj in range(n_obj):
+        parent = parents[obj]
+        if parent >= 0:
+            child_idx[fill[parent]] = obj
+            fill[parent] += 1
+
+    return child_ptr, child_idx
+
+@njit
+def transform_locs_csr(child_ptr,child_idx,locs_rel,locs_abs):
+    ## breadth-first from the roots, which keep their given locs_abs. Each object is visited once; ids can be in any order.
+    ## A child listed again (under a second parent, or through a cycle) is skipped, so the queue never outgrows n_obj;
+    ## objects on a cycle that no root reaches are left as given
+    n_obj = child_ptr.shape[0] - 1
+
+    is_child = np.zeros(n_obj, dtype=np.bool_)
+    for k in range(child_idx.shape[0]):
+        if child_idx[k] < 0 or child_idx[k] >= n_obj: raise ValueError('child_idx holds an id outside 0..n_obj-1')
+        is_child[child_idx[k]] = True
+
+    visited = np.zeros(n_obj, dtype=np.bool_)
+    queue = np.empty(n_obj, dtype=np.int32)
+    head, tail = 0, 0
+    for obj in range(n_obj):
+        if not is_child[obj]:
+            visited[obj] = True
+            queue[tail] = obj
+            tail += 1
+
+    while head < tail:
+        parent = queue[head]
+        head += 1
+
+        for k in range(child_ptr[parent], child_ptr[parent + 1]):
+            child = child_idx[k]
+            if visited[child]: continue
+            visited[child] = True
+
+            locs_abs[child] = locs_rel[child] + locs_abs[parent]
+            queue[tail] = child
+            tail += 1
+
+    return locs_abs
+
+@njit
+def transform_locs_parents(parents,locs_rel,locs_abs):
+    child_ptr, child_idx = parents_to_csr(parents)
+    return transform_locs_csr(child_ptr, child_idx, locs_rel, locs_abs)
+
+@njit(parallel=True)
+def render_imgs(imgs,locs_abs,depths,z_buffer,f_buffer):
+    z_buffer.fill(Z_MAX)
+    f_buffer.fill(0)
+
+    for loop in range(len(imgs)):
+
+        img = imgs[loop]
+        abs_depth = depths[loop]
+        abs_y, abs_x = locs_abs[loop][0], locs_abs[loop][1]
+
+        for i in prange(img.shape[0]):
+            for j in range(img.shape[1]):
+
+                if (abs_y + i < f_buffer.shape[0]) and (abs_x + j < f_buffer.shape[1]):
+
+                    if z_buffer[abs_y + i, abs_x + j] > abs_depth:
+                        z_buffer[abs_y + i, abs_x + j] = abs_depth
+                        f_buffer[abs_y + i, abs_x + j] = img[i,j]
+
+@njit
+def transform_and_render_sparse(imgs,img_sizes,parents,locs_rel,locs_abs,depths,z_buffer,f_buffer):
+    transform_locs_parents(parents, locs_rel, locs_abs)
+    render_imgs(imgs, locs_abs, depths, z_buffer, f_buffer)
+
+@njit
+def transform_and_render_csr(imgs,img_sizes,child_ptr,child_idx,locs_rel,locs_abs,depths,z_buffer,f_buffer):
+    transform_locs_csr(child_ptr, child_idx, locs_rel, locs_abs)
+    render_imgs(imgs, locs_abs, depths, z_buffer, f_buffer)
+
+def transform_any(tree,locs_rel,locs_abs):
+    ## tree is a dense child_mat, a parents array, or a (child_ptr, child_idx) tuple
+    if isinstance(tree, tuple): return transform_locs_csr(*tree, locs_rel, locs_abs)
+    if tree.ndim == 1: return transform_locs_parents(tree, locs_rel, locs_abs)
+    return transform_locs(tree, locs_rel, locs_abs)
+
+
+
+###########################################################################################
+###########################################################################################
+###### Tile-Binned Parallel Rendering
+## Images are binned into square screen tiles, then tiles are composited in parallel. A tile owns its pixels in
+## z_buffer and f_buffer, so depth is resolved per tile without races, and work spreads over all cores even when
+## every image is small.
+
+TILE = 64
+
+@njit
+def bin_imgs(img_sizes,locs_abs,frame_size,tile):
+    ## CSR of image ids per tile: images overlapping tile t are tile_ids[tile_ptr[t]:tile_ptr[t+1]], in image order
+    n_tiles_y = (frame_size[0] + tile - 1) // tile
+    n_tiles_x = (frame_size[1] + tile - 1) // tile
+    n_imgs = img_sizes.shape[0]
+
+    ## clipped tile range of each image, inclusive-exclusive
+    ranges = np.zeros((n_imgs, 4), dtype=np.int32)
+    tile_ptr = np.zeros(n_tiles_y * n_tiles_x + 1, dtype=np.int32)
+    for im in range(n_imgs):
+        y0, x0 = max(locs_abs[im,0], 0), max(locs_abs[im,1], 0)
+        y1 = min(locs_abs[im,0] + img_sizes[im,0], frame_size[0])
+        x1 = min(locs_abs[im,1] + img_sizes[im,1], frame_size[1])
+        if y1 <= y0 or x1 <= x0: continue
+
+        ranges[im,0], ranges[im,1] = y0 // tile, x0 // tile
+        ranges[im,2], ranges[im,3] = (y1 - 1) // tile + 1, (x1 - 1) // tile + 1
+
+        for ty in range(ranges[im,0], ranges[im,2]):
+            for tx in range(ranges[im,1], ranges[im,3]):
+                tile_ptr[ty * n_tiles_x + tx + 1] += 1
+
+    for t in range(n_tiles_y * n_tiles_x):
+        tile_ptr[t + 1] += tile_ptr[t]
+
+    tile_ids = np.empty(tile_ptr[-1], dtype=np.int32)
+    fill = tile_ptr[:-1].copy()
+    for im in range(n_imgs):
+        for ty in range(ranges[im,0], ranges[im,2]):
+            for tx in range(ranges[im,1], ranges[im,3]):
+                t = ty * n_tiles_x + tx
+                tile_ids[fill[t]] = im
+                fill[t] += 1
+
+    return tile_ptr, tile_ids, n_tiles_x
+
+@njit(parallel=True)
+def render_tiled(imgs,img_sizes,locs_abs,depths,z_buffer,f_buffer,tile=TILE):
+    frame_size = (f_buffer.shape[0], f_buffer.shape[1])
+    tile_ptr, tile_ids, n_tiles_x = bin_imgs(img_sizes, locs_abs, frame_size, tile)
+
+    for t in prange(tile_ptr.shape[0] - 1):
+        y0, x0 = (t // n_tiles_x) * tile, (t % n_tiles_x) * tile
+        y1, x1 = min(y0 + tile, frame_size[0]), min(x0 + tile, frame_size[1])
+
+        z_buffer[y0:y1, x0:x1] = Z_MAX
+        f_buffer[y0:y1, x0:x1] = 0
+
+        for k in range(tile_ptr[t], tile_ptr[t + 1]):
+            im = tile_ids[k]
+
+            img = imgs[im]
+            abs_depth = depths[im]
+            abs_y, abs_x = locs_abs[im,0], locs_abs[im,1]
+
+            iy0, iy1 = max(y0, abs_y), min(y1, abs_y + img.shape[0])
+            ix0, ix1 = max(x0, abs_x), min(x1, abs_x + img.shape[1])
+
+            for i in range(iy0, iy1):
+                for j in range(ix0, ix1):
+
+                    if z_buffer[i,j] > abs_depth:
+                        z_buffer[i,j] = abs_depth
+                        f_buffer[i,j] = img[i - abs_y, j - abs_x]
+
+@njit
+def transform_and_render_tiled(imgs,img_sizes,parents,locs_rel,locs_abs,depths,z_buffer,f_buffer,tile=TILE):
+    transform_locs_parents(parents, locs_rel, locs_abs)
+    render_tiled(imgs, img_sizes, locs_abs, depths, z_buffer, f_buffer, tile)
+
+
+
+###########################################################################################
+###########################################################################################
+###### Painter's-Algorithm Rendering
+## Each image has one constant depth, so sorting images once per frame and drawing back-to-front gives the same frame
+## as the z-buffer without reading or writing one. Pixels are plain slice copies.
+
+@njit(nogil=True)
+def depth_order(depths):
+    ## back-to-front draw order. Equal depths draw higher ids first, so the lower id wins as under the z-buffer's strict compare
+    return np.argsort(depths, kind='mergesort')[::-1]
+
+@njit(nogil=True)
+def render_painter(imgs,img_sizes,locs_abs,depths,f_buffer):
+    f_buffer.fill(0)
+
+    for im in depth_order(depths):
+        img = imgs[im]
+        abs_y, abs_x = locs_abs[im,0], locs_abs[im,1]
+
+        y0, y1 = max(abs_y, 0), min(abs_y + img.shape[0], f_buffer.shape[0])
+        x0, x1 = max(abs_x, 0), min(abs_x + img.shape[1], f_buffer.shape[1])
+        if y1 <= y0 or x1 <= x0: continue
+
+        f_buffer[y0:y1, x0:x1] = img[y0 - abs_y : y1 - abs_y, x0 - abs_x : x1 - abs_x]
+
+@njit
+def transform_and_render_painter(imgs,img_sizes,parents,locs_rel,locs_abs,depths,f_buffer):
+    transform_locs_parents(parents, locs_rel, locs_abs)
+    render_painter(imgs, img_sizes, locs_abs, depths, f_buffer)
+
+
+
+###########################################################################################
+###########################################################################################
+###### Incremental (Dirty-Rectangle) Rendering
+
+@njit(parallel=True)
+def composite_rects(imgs,locs_abs,depths,rects,z_buffer,f_buffer):
+    ## clear each rect (y0,x0,y1,x1) and re-composite every image that overlaps it, clipped to the rect
+
+    for r in range(rects.shape[0]):
+        y0, x0, y1, x1 = rects[r,0], rects[r,1], rects[r,2], rects[r,3]
+
+        z_buffer[y0:y1, x0:x1] = Z_MAX
+        f_buffer[y0:y1, x0:x1] = 0
+
+        for loop in range(len(imgs)):
+
+            img = imgs[loop]
+            abs_depth = depths[loop]
+            abs_y, abs_x = locs_abs[loop][0], locs_abs[loop][1]
+
+            iy0, iy1 = max(y0, abs_y), min(y1, abs_y + img.shape[0])
+            ix0, ix1 = max(x0, abs_x), min(x1, abs_x + img.shape[1])
+
+            for i in prange(iy0, iy1):
+                for j in range(ix0, ix1):
+
+                    if z_buffer[i,j] > abs_depth:
+                        z_buffer[i,j] = abs_depth
+                        f_buffer[i,j] = img[i - abs_y, j - abs_x]
+
+def sprite_rects(img_sizes,locs_abs,frame_size):
+    ## screen-space bounding box (y0,x0,y1,x1) of each image, clipped to the frame; empty boxes have y0==y1 or x0==x1
+    y0 = np.clip(locs_abs[:,0], 0, frame_size[0])
+    x0 = np.clip(locs_abs[:,1], 0, frame_size[1])
+    y1 = np.clip(locs_abs[:,0] + img_sizes[:,0], 0, frame_size[0])
+    x1 = np.clip(locs_abs[:,1] + img_sizes[:,1], 0, frame_size[1])
+    return np.stack([y0,x0,y1,x1], 1).astype(np.int32)
+
+def transform_and_render_dirty(imgs,img_sizes,tree,locs_rel,locs_abs,depths,z_buffer,f_buffer,prev=None):
+    '''
+        Incremental version of transform_and_render. z_buffer and f_buffer must still hold the frame rendered from prev.
+        tree can be any form accepted by transform_any.
+
+        Images whose location, size, depth or pixels changed since prev are marked dirty; the regions they covered
+        in the previous frame and cover in this one are cleared and re-composited, and nothing else is touched.
+        With prev=None, or when the number of images changed, the whole frame is redrawn.
+
+        Returns (dirty_rects, prev): dirty_rects is an int32 (n,4) array of (y0,x0,y1,x1) regions that changed, and
+        prev must be passed back in with the next state.
+    '''
+    frame_size = f_buffer.shape[:2]
+
+    transform_any(tree, locs_rel, locs_abs)
+    rects = sprite_rects(img_sizes, locs_abs, frame_size)
+
+    if prev is None or len(prev[0]) != len(imgs):
+        dirty = np.array([[0, 0, frame_size[0], frame_size[1]]], dtype=np.int32)
+
+    else:
+        prev_imgs, prev_rects, prev_depths = prev
+
+        changed = np.any(rects != prev_rects, axis=1) | (depths != prev_depths)
+        for i in range(len(imgs)):
+            if changed[i] or imgs[i] is prev_imgs[i]: continue
+            changed[i] = not np.array_equal(imgs[i], prev_imgs[i])
+
+        dirty = np.concatenate([prev_rects[changed], rects[changed]])
+        dirty = dirty[ (dirty[:,2] > dirty[:,0]) & (dirty[:,3] > dirty[:,1]) ]
+        dirty = np.unique(dirty, axis=0)
+
+    if len(dirty): composite_rects(imgs, locs_abs, depths, dirty, z_buffer, f_buffer)
+
+    return dirty, (imgs, rects, depths.copy())
+
+
+
+
+###########################################################################################
+###########################################################################################
+###### Batched Offline Rendering
+## Renders many states into one preallocated (n, H, W, 3) uint8 array. Each frame is rendered serially with the
+## painter's path, which releases the GIL, and frames run concurrently on a thread pool; no z_buffer per worker.
+
+def render_frame(state,f_buffer):
+    imgs,img_sizes,tree,locs_rel,locs_abs,depths = state
+    transform_any(tree, locs_rel, locs_abs)
+    render_painter(imgs, img_sizes, locs_abs, depths, f_buffer)
+
+def render_batch(states,out=None,out_path=None,frame_size=FRAME_SIZE,n_workers=None):
+    '''
+        states: sequence of numpy states (imgs,img_sizes,tree,locs_rel,locs_abs,depths); tree as for transform_any
+        out: optional preallocated uint8 array of shape (len(states), H, W, 3)
+        out_path: if out is not given, frames are written to a memory-mapped .npy file at this path instead of RAM
+
+        Returns the output array (an np.memmap when out_path is used).
+    '''
+    n_frames = len(states)
+    shape = (n_frames, *frame_size, 3)
+
+    if out is None:
+        if out_path is not None: out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=shape)
+        else: out = np.empty(shape, dtype=np.uint8)
+
+    if n_workers is None: n_workers = os.cpu_count()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as exec:
+        for _ in exec.map(lambda i: render_frame(states[i], out[i]), range(n_frames)): pass
+
+    if isinstance(out, np.memmap): out.flush()
+    return out
+
+
 if __name__ == "__main__":
     pass
 
@@ -17,6 +17,30 @@ std::vector<torch::Tensor> render_call(
     torch::Tensor lock_buffer
 );
 
+std::vector<torch::Tensor> render_sparse_call(
+    std::vector<torch::Tensor> imgs,
+    torch::Tensor img_sizes,
+    torch::Tensor parents,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs,
+    torch::Tensor depths,
+
+    torch::Tensor z_buffer,
+    torch::Tensor f_buffer,
+    torch::Tensor lock_buffer
+);
+
+std::vector<torch::Tensor> render_painter_call(
+    std::vector<torch::Tensor> imgs,
+    torch::Tensor img_sizes,
+    torch::Tensor parents,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs,
+    torch::Tensor depths,
+
+    torch::Tensor f_buffer
+);
+
 #define CHECK_CUDA(x) AT_ASSERTM(x.is_cuda(), #x " must be a CUDA tensor")
 #define CHECK_CONTIGUOUS(x) AT_ASSERTM(x.is_contiguous(), #x " must be contiguous")
 #define CHECK_INPUT(x) CHECK_CUDA(x); CHECK_CONTIGUOUS(x)
@@ -59,6 +83,80 @@ std::vector<torch::Tensor> render(
     );
 }
 
+// same as render, with the object tree given as a parent-id array (int32, -1 for roots) instead of a dense child_mat
+std::vector<torch::Tensor> render_sparse(
+    std::vector<torch::Tensor> imgs,
+    torch::Tensor img_sizes,
+    torch::Tensor parents,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs,
+    torch::Tensor depths,
+
+    torch::Tensor z_buffer,
+    torch::Tensor f_buffer,
+    torch::Tensor lock_buffer
+    )
+{
+    for (int i = 0; i < imgs.size(); i++) { CHECK_INPUT(imgs[i]); }
+    CHECK_INPUT(img_sizes);
+    CHECK_INPUT(parents);
+    CHECK_INPUT(locs_rel);
+    CHECK_INPUT(locs_abs);
+    CHECK_INPUT(depths);
+
+    CHECK_INPUT(z_buffer);
+    CHECK_INPUT(f_buffer);
+    CHECK_INPUT(lock_buffer);
+
+    return render_sparse_call(
+        imgs,
+        img_sizes,
+        parents,
+        locs_rel,
+        locs_abs,
+        depths,
+
+        z_buffer,
+        f_buffer,
+        lock_buffer
+    );
+}
+
+// painter's-algorithm render: ranks images by depth on the device and blits them in one kernel; no z_buffer or lock_buffer
+std::vector<torch::Tensor> render_painter(
+    std::vector<torch::Tensor> imgs,
+    torch::Tensor img_sizes,
+    torch::Tensor parents,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs,
+    torch::Tensor depths,
+
+    torch::Tensor f_buffer
+    )
+{
+    for (int i = 0; i < imgs.size(); i++) { CHECK_INPUT(imgs[i]); }
+    CHECK_INPUT(img_sizes);
+    CHECK_INPUT(parents);
+    CHECK_INPUT(locs_rel);
+    CHECK_INPUT(locs_abs);
+    CHECK_INPUT(depths);
+
+    CHECK_INPUT(f_buffer);
+
+    return render_painter_call(
+        imgs,
+        img_sizes,
+        parents,
+        locs_rel,
+        locs_abs,
+        depths,
+
+        f_buffer
+    );
+}
+
 TORCH_LIBRARY(render_op, m) {
     m.def("render_kernel", render);
+    m.def("render_sparse_kernel", render_sparse);
+    m.def("render_painter_kernel", render_painter);
 }
\ No newline at end of file
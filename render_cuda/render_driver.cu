@@ -13,6 +13,7 @@ Author: Chris Henn (https://github.com/chrishenn)
 #include <cstdint>
 #include <cassert>
 #include <iostream>
+#include <algorithm>
 
 // define for error checking
 //#define CUDA_ERROR_CHECK
@@ -51,16 +52,24 @@ const int BUFF_H = 1080;
 const int BUFF_D = 3;
 
 const int Z_MAX = 268435455;
+const int Z_MAX_16 = 32767;
+
+// empty value for a z_buffer: int16 z_buffers are usable whenever every depth is < Z_MAX_16
+inline int z_max_for(const torch::Tensor& z_buffer){
+    return (z_buffer.scalar_type() == torch::kInt16) ? Z_MAX_16 : Z_MAX;
+}
 
 
+// z_t is int32 or int16; f_t is uint8 (compact frames) or int32 (legacy frames)
+template <typename z_t, typename f_t>
 __global__ void render_kernel(
         const u_int8_t** img_ptrs,
         const int* img_sizes,
         const int* depths,
         const int* locs_abs,
 
-        int* z_buffer,
-        int* f_buffer,
+        z_t* z_buffer,
+        f_t* f_buffer,
         int* lock_buffer
 ){
 
@@ -105,7 +114,7 @@ __global__ void render_kernel(
 
                     if (im_depth < curr_z) {
 
-                        z_buffer[buff_y * BUFF_W + buff_x] = im_depth;
+                        z_buffer[buff_y * BUFF_W + buff_x] = (z_t) im_depth;
 
                         // write pixel at this buff_loc to f_buff
                         // #pragma unroll
@@ -116,7 +125,7 @@ __global__ void render_kernel(
 
                             // f_buff is H x W x D
                             auto lin_buff_loc = (buff_y * BUFF_W * BUFF_D) + (buff_x * BUFF_D) + chan;
-                            f_buffer[lin_buff_loc] = val;
+                            f_buffer[lin_buff_loc] = (f_t) val;
                         }
                     }
                     atomicExch(&lock_buffer[buff_y * BUFF_W + buff_x], 0);
@@ -164,11 +173,167 @@ __global__ void transform_locs(
 
 
 
-__host__ std::vector<torch::Tensor> render_call(
+// parent-id trees are transformed by pointer jumping, entirely on the device: no host copy of parents and no sync.
+// jump[i] is an ancestor of i and offs[i] = abs loc of i - abs loc of jump[i]; each step doubles the distance jumped,
+// so ceil(log2(n_obj)) steps of O(n_obj) reach the root from any depth. roots point at themselves with offs 0.
+__global__ void jump_init(
+        const int* parents,
+        const int n_obj,
+        const int* locs_rel,
+
+        int* jump,
+        int* offs
+){
+    for (int obj = blockIdx.x * blockDim.x + threadIdx.x; obj < n_obj; obj += blockDim.x * gridDim.x){
+        auto parent = parents[obj];
+
+        // roots, and ids out of range: jump_apply leaves these and everything below a bad id as given
+        if (parent < 0 || parent >= n_obj){
+            jump[obj] = obj;
+            offs[obj * 2 + 0] = 0;
+            offs[obj * 2 + 1] = 0;
+        }
+        else {
+            jump[obj] = parent;
+            offs[obj * 2 + 0] = locs_rel[obj * 2 + 0];
+            offs[obj * 2 + 1] = locs_rel[obj * 2 + 1];
+        }
+    }
+}
+
+__global__ void jump_step(
+        const int n_obj,
+        const int* jump_in,
+        const int* offs_in,
+
+        int* jump_out,
+        int* offs_out
+){
+    for (int obj = blockIdx.x * blockDim.x + threadIdx.x; obj < n_obj; obj += blockDim.x * gridDim.x){
+        auto next = jump_in[obj];
+        jump_out[obj] = jump_in[next];
+        offs_out[obj * 2 + 0] = offs_in[obj * 2 + 0] + offs_in[next * 2 + 0];
+        offs_out[obj * 2 + 1] = offs_in[obj * 2 + 1] + offs_in[next * 2 + 1];
+    }
+}
+
+__global__ void jump_apply(
+        const int* parents,
+        const int n_obj,
+        const int* jump,
+        const int* offs,
+
+        int* locs_abs
+){
+    for (int obj = blockIdx.x * blockDim.x + threadIdx.x; obj < n_obj; obj += blockDim.x * gridDim.x){
+        auto root = jump[obj];
+
+        // roots keep their given abs loc
+        if (root == obj) continue;
+
+        // still short of a root after every step: obj is on or under a cycle in parents, or under a bad id.
+        // left as given, like the objects a breadth-first walk from the roots never reaches
+        if (parents[root] >= 0) continue;
+
+        locs_abs[obj * 2 + 0] = locs_abs[root * 2 + 0] + offs[obj * 2 + 0];
+        locs_abs[obj * 2 + 1] = locs_abs[root * 2 + 1] + offs[obj * 2 + 1];
+    }
+}
+
+// transform relative locs to abs locs within the f_buff, for a tree given as parent ids
+__host__ void transform_locs_parents(
+    torch::Tensor parents,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs
+) {
+    int n_obj = parents.size(0);
+    if (n_obj == 0) return;
+
+    // two (jump, offs) buffers, swapped each step
+    auto jump = torch::empty({2, n_obj}, parents.options());
+    auto offs = torch::empty({2, n_obj, 2}, parents.options());
+
+    int n_threads = 256;
+    int n_blocks = (n_obj + n_threads - 1) / n_threads;
+
+    jump_init<<<n_blocks,n_threads>>>(
+        parents.data_ptr<int>(), n_obj, locs_rel.data_ptr<int>(),
+        jump.data_ptr<int>(), offs.data_ptr<int>()
+    );
+    CudaCheckError();
+
+    int cur = 0;
+    for (int span = 1; span < n_obj; span *= 2){
+        jump_step<<<n_blocks,n_threads>>>(
+            n_obj, jump.data_ptr<int>() + cur * n_obj, offs.data_ptr<int>() + cur * n_obj * 2,
+            jump.data_ptr<int>() + (1 - cur) * n_obj, offs.data_ptr<int>() + (1 - cur) * n_obj * 2
+        );
+        CudaCheckError();
+        cur = 1 - cur;
+    }
+
+    jump_apply<<<n_blocks,n_threads>>>(
+        parents.data_ptr<int>(), n_obj, jump.data_ptr<int>() + cur * n_obj, offs.data_ptr<int>() + cur * n_obj * 2,
+        locs_abs.data_ptr<int>()
+    );
+    CudaCheckError();
+}
+
+
+
+// painter's blit: block k draws image order[k], and order is back-to-front, so nearer images have larger k.
+// blocks run in no fixed order, so each pixel keeps the largest (k+1, rgb) pair, packed into 64 bits and written with
+// one atomicMax: the nearest image wins without a lock or a z_buffer. resolve_painter unpacks the winners.
+__global__ void painter_kernel(
+        const u_int8_t** img_ptrs,
+        const int* img_sizes,
+        const int64_t* order,
+        const int* locs_abs,
+
+        unsigned long long* pix_buffer
+){
+    const auto img_i = order[blockIdx.x];
+    const auto img_ptr_i = img_ptrs[img_i];
+
+    const auto img_size_0 = img_sizes[img_i * 2 + 0];
+    const auto img_size_1 = img_sizes[img_i * 2 + 1];
+
+    const auto im_start_y = locs_abs[img_i * 2 + 0];
+    const auto im_start_x = locs_abs[img_i * 2 + 1];
+
+    const unsigned long long rank = (unsigned long long) (blockIdx.x + 1) << 32;
+
+    // consecutive threads take consecutive pixels of the image, so reads of the image coalesce
+    for (int pix = threadIdx.x; pix < img_size_0 * img_size_1; pix += blockDim.x){
+        auto buff_y = im_start_y + pix / img_size_1;
+        auto buff_x = im_start_x + pix % img_size_1;
+        if (buff_y < 0 || buff_y >= BUFF_H || buff_x < 0 || buff_x >= BUFF_W) continue;
+
+        auto px = img_ptr_i + pix * BUFF_D;
+        unsigned long long rgb = ((unsigned long long) px[0] << 16) | ((unsigned long long) px[1] << 8) | px[2];
+        atomicMax(&pix_buffer[buff_y * BUFF_W + buff_x], rank | rgb);
+    }
+}
+
+// unpack painter_kernel's winners into the uint8 f_buffer; pixels no image covered are 0, i.e. black
+__global__ void resolve_painter(
+        const unsigned long long* pix_buffer,
+        u_int8_t* f_buffer
+){
+    for (int i = blockIdx.x * blockDim.x + threadIdx.x; i < BUFF_H * BUFF_W; i += blockDim.x * gridDim.x){
+        auto rgb = pix_buffer[i];
+        f_buffer[i * BUFF_D + 0] = (rgb >> 16) & 0xFF;
+        f_buffer[i * BUFF_D + 1] = (rgb >> 8) & 0xFF;
+        f_buffer[i * BUFF_D + 2] = rgb & 0xFF;
+    }
+}
+
+
+
+// composite imgs onto f_buff at locs_abs; locs_abs must already be transformed
+__host__ void render_imgs(
     std::vector<torch::Tensor> imgs,
     torch::Tensor img_sizes,
-    torch::Tensor child_mat,
-    torch::Tensor locs_rel,
     torch::Tensor locs_abs,
     torch::Tensor depths,
 
@@ -176,23 +341,70 @@ __host__ std::vector<torch::Tensor> render_call(
     torch::Tensor f_buffer,
     torch::Tensor lock_buffer
 ) {
-
-    using namespace torch::indexing;
-    auto device_id = child_mat.get_device();
-    cudaSetDevice(device_id);
-
     // convert std::vector of imgs into an array of device pointers, to pass to device code
     u_int8_t** img_ptrs;
     cudaMalloc((void**) &img_ptrs, imgs.size() * sizeof(u_int8_t*));
 
-    u_int8_t** tmp_d_ptrs = (u_int8_t**) malloc(imgs.size() * sizeof(u_int8_t*));
+    std::vector<u_int8_t*> tmp_d_ptrs(imgs.size());
     for (int i = 0; i < imgs.size(); i++){
         tmp_d_ptrs[i] = imgs[i].data_ptr<u_int8_t>();
     }
-    cudaMemcpy(img_ptrs, tmp_d_ptrs, imgs.size() * sizeof(u_int8_t*), cudaMemcpyHostToDevice);
+    cudaMemcpy(img_ptrs, tmp_d_ptrs.data(), imgs.size() * sizeof(u_int8_t*), cudaMemcpyHostToDevice);
+
+    // render imgs onto f_buff, for whichever z_buff and f_buff dtypes were passed in
+    auto n_threads = 256;
+    auto z_16 = (z_buffer.scalar_type() == torch::kInt16);
+    auto f_8 = (f_buffer.scalar_type() == torch::kUInt8);
+
+    if (z_16 && f_8){
+        render_kernel<int16_t, u_int8_t><<<imgs.size(),n_threads>>>(
+            img_ptrs, img_sizes.data_ptr<int>(), depths.data_ptr<int>(), locs_abs.data_ptr<int>(),
+            z_buffer.data_ptr<int16_t>(), f_buffer.data_ptr<u_int8_t>(), lock_buffer.data_ptr<int>()
+        );
+    }
+    else if (f_8){
+        render_kernel<int, u_int8_t><<<imgs.size(),n_threads>>>(
+            img_ptrs, img_sizes.data_ptr<int>(), depths.data_ptr<int>(), locs_abs.data_ptr<int>(),
+            z_buffer.data_ptr<int>(), f_buffer.data_ptr<u_int8_t>(), lock_buffer.data_ptr<int>()
+        );
+    }
+    else if (z_16){
+        render_kernel<int16_t, int><<<imgs.size(),n_threads>>>(
+            img_ptrs, img_sizes.data_ptr<int>(), depths.data_ptr<int>(), locs_abs.data_ptr<int>(),
+            z_buffer.data_ptr<int16_t>(), f_buffer.data_ptr<int>(), lock_buffer.data_ptr<int>()
+        );
+    }
+    else {
+        render_kernel<int, int><<<imgs.size(),n_threads>>>(
+            img_ptrs, img_sizes.data_ptr<int>(), depths.data_ptr<int>(), locs_abs.data_ptr<int>(),
+            z_buffer.data_ptr<int>(), f_buffer.data_ptr<int>(), lock_buffer.data_ptr<int>()
+        );
+    }
+    CudaCheckError();
+
+    // cudaFree waits for the kernel to finish with the pointer array
+    cudaFree(img_ptrs);
+}
+
+__host__ std::vector<torch::Tensor> render_call(
+    std::vector<torch::Tensor> imgs,
+    torch::Tensor img_sizes,
+    torch::Tensor child_mat,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs,
+    torch::Tensor depths,
+
+    torch::Tensor z_buffer,
+    torch::Tensor f_buffer,
+    torch::Tensor lock_buffer
+) {
+
+    using namespace torch::indexing;
+    auto device_id = child_mat.get_device();
+    cudaSetDevice(device_id);
 
     // refresh persistent buffers
-    z_buffer.fill_(Z_MAX);
+    z_buffer.fill_(z_max_for(z_buffer));
     f_buffer.fill_(0);
     lock_buffer.fill_(0);
 
@@ -207,18 +419,88 @@ __host__ std::vector<torch::Tensor> render_call(
         locs_abs.data_ptr<int>()
     );
 
-    // render imgs onto f_buff
-    auto n_threads = 256;
-    render_kernel<<<imgs.size(),n_threads>>>(
-        img_ptrs,
-        img_sizes.data_ptr<int>(),
-        depths.data_ptr<int>(),
-        locs_abs.data_ptr<int>(),
-
-        z_buffer.data_ptr<int>(),
-        f_buffer.data_ptr<int>(),
-        lock_buffer.data_ptr<int>()
+    render_imgs(imgs, img_sizes, locs_abs, depths, z_buffer, f_buffer, lock_buffer);
+
+    return {};
+}
+
+__host__ std::vector<torch::Tensor> render_sparse_call(
+    std::vector<torch::Tensor> imgs,
+    torch::Tensor img_sizes,
+    torch::Tensor parents,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs,
+    torch::Tensor depths,
+
+    torch::Tensor z_buffer,
+    torch::Tensor f_buffer,
+    torch::Tensor lock_buffer
+) {
+
+    auto device_id = parents.get_device();
+    cudaSetDevice(device_id);
+
+    // refresh persistent buffers
+    z_buffer.fill_(z_max_for(z_buffer));
+    f_buffer.fill_(0);
+    lock_buffer.fill_(0);
+
+    transform_locs_parents(parents, locs_rel, locs_abs);
+
+    render_imgs(imgs, img_sizes, locs_abs, depths, z_buffer, f_buffer, lock_buffer);
+
+    return {};
+}
+
+// painter's algorithm: every image has a single depth, so images are ranked back-to-front once and the nearest one
+// per pixel wins. Everything stays on the device: the transform, the sort, and one blit kernel for all images.
+// No z_buffer or lock_buffer; f_buffer must be uint8.
+__host__ std::vector<torch::Tensor> render_painter_call(
+    std::vector<torch::Tensor> imgs,
+    torch::Tensor img_sizes,
+    torch::Tensor parents,
+    torch::Tensor locs_rel,
+    torch::Tensor locs_abs,
+    torch::Tensor depths,
+
+    torch::Tensor f_buffer
+) {
+
+    auto device_id = parents.get_device();
+    cudaSetDevice(device_id);
+    TORCH_CHECK(f_buffer.scalar_type() == torch::kUInt8, "render_painter needs a uint8 f_buffer");
+
+    // packed (rank, rgb) per pixel; 0 is below every image's rank
+    auto pix_buffer = torch::zeros({BUFF_H, BUFF_W}, f_buffer.options().dtype(torch::kInt64));
+
+    int n_obj = parents.size(0);
+    if (n_obj > 0){
+        transform_locs_parents(parents, locs_rel, locs_abs);
+
+        // back-to-front; equal depths draw higher ids first, so the lower id wins as under the z-buffer's strict compare
+        auto order = std::get<1>(depths.sort(/*stable=*/true, /*dim=*/0, /*descending=*/false)).flip(0).contiguous();
+
+        // device pointers of imgs, uploaded as a tensor: pageable memory is staged at once, so the copy does not wait
+        // for the device, and the caching allocator frees it in stream order with no cudaFree sync
+        std::vector<int64_t> tmp_d_ptrs(imgs.size());
+        for (int i = 0; i < imgs.size(); i++){
+            tmp_d_ptrs[i] = (int64_t) imgs[i].data_ptr<u_int8_t>();
+        }
+        auto img_ptrs = torch::from_blob(tmp_d_ptrs.data(), {(int64_t) imgs.size()}, torch::kInt64)
+                            .to(parents.device(), /*non_blocking=*/true);
+
+        painter_kernel<<<n_obj,256>>>(
+            (const u_int8_t**) img_ptrs.data_ptr<int64_t>(), img_sizes.data_ptr<int>(), order.data_ptr<int64_t>(),
+            locs_abs.data_ptr<int>(), (unsigned long long*) pix_buffer.data_ptr<int64_t>()
+        );
+        CudaCheckError();
+    }
+
+    int n_threads = 256;
+    resolve_painter<<<(BUFF_H * BUFF_W + n_threads - 1) / n_threads, n_threads>>>(
+        (const unsigned long long*) pix_buffer.data_ptr<int64_t>(), f_buffer.data_ptr<u_int8_t>()
     );
+    CudaCheckError();
 
     return {};
 }
@@ -3,20 +3,35 @@ import logging
 import signal
 import psutil
 
+import numpy as np
 import torch as t
 import torch.multiprocessing as mp
 
 import concurrent.futures
 
+import tornado.options
 import tornado.process
 from tornado.ioloop import IOLoop
+from tornado.options import define, options
 
 import server
+from frame_ring import FrameRing
+from input_state import InputRing, MouseSlot
+from frame_pacing import FramePacer
+from asset_store import AssetStore, resolve_state
 t.ops.load_library(os.path.join(os.path.split(__file__)[0], 'render_cuda/build/librender.so'))
 
 ## (y,x)
 FRAME_SIZE = (1080,1920)
 IMG_DIR = os.path.join( os.path.split(__file__)[0], 'images' )
+ASSET_PATH = '/home/chris/Documents/agent_interface/assets.npz'
+
+## every image has one depth: sort and draw back-to-front instead of testing a z-buffer per pixel.
+## set False to keep the z-buffer path (e.g. for per-pixel depth)
+PAINTER_RENDER = True
+
+define('agent_fps', default=60.0, type=float, help='target agent frame rate; inputs arriving within a frame are handled in one step')
+define('agent_idle_step', default=False, type=bool, help='step and render the agent every frame, even when no input arrived')
 
 
 
@@ -24,11 +39,13 @@ IMG_DIR = os.path.join( os.path.split(__file__)[0], 'images' )
 ###########################################################################################
 ###### Helpers
 
+## id states keep their asset ids on the host; their images are uploaded once by the AssetStore
 def to_gpu(states):
 
     for i,state in enumerate(states):
 
-        state_0 = tuple( [img.cuda() for img in state[0]] )
+        if isinstance(state[0], tuple): state_0 = tuple( [img.cuda() for img in state[0]] )
+        else: state_0 = state[0]
         others = tuple( [tem.cuda() for tem in state[1:]] )
         states[i] = tuple( [state_0, *others] )
     return states
@@ -37,40 +54,57 @@ def to_numpy_state(states):
 
     for i,state in enumerate(states):
 
-        state_0 = tuple( [img.numpy() for img in state[0]] )
+        if isinstance(state[0], tuple): state_0 = tuple( [img.numpy() for img in state[0]] )
+        else: state_0 = state[0].numpy()
         others = tuple( [tem.numpy() for tem in state[1:]] )
         states[i] = tuple( [state_0, *others] )
     return states
 
+## largest depth that an int16 z_buffer can hold below its empty value
+Z_MAX_16 = 32766
+
+def z_dtype(states):
+    ## 16-bit z_buffer when every depth fits, else 32-bit
+    max_depth = max( int(state[5].max()) for state in states )
+    if max_depth <= Z_MAX_16: return t.int16
+    return t.int32
+
+def to_sparse(states):
+    ## replace each state's dense n x n child_mat with a parent-id array (-1 for roots), as taken by render_sparse_kernel
+    for i,state in enumerate(states):
+        imgs, img_sizes, child_mat, *others = state
+
+        parents = t.full([child_mat.shape[0]], -1, dtype=t.int32, device=child_mat.device)
+        rows, cols = child_mat.nonzero(as_tuple=True)
+        parents[cols] = rows.to(t.int32)
+
+        states[i] = tuple( [imgs, img_sizes, parents, *others] )
+    return states
+
+def dirty_rect(frame, prev):
+    ## (y0, x0, y1, x1) bounding box of the pixels that differ between two device frames; (0, 0, 0, 0) if none do
+    changed = (frame != prev).any(dim=2)
+    rows = changed.any(dim=1).nonzero()
+    if rows.numel() == 0: return (0, 0, 0, 0)
+    cols = changed.any(dim=0).nonzero()
+    return (int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1)
+
 ###########################################################################################
 ###########################################################################################
 ###### Agent Loop
 
-def flush_q(queue):
-    try:
-        while True:
-            queue.get_nowait()
-    except: pass
-
-async def get_blocking(queue):
-    try:
-        item = queue.get()
-        return item
-    except Exception as e:
-        print('agent proc: on blocking_q.get(), caught exception', type(e), ' : ', e, '; raising')
-        raise e
-
 def print_loc(obj):
     print('agent proc: got mouse location:', obj)
 
 def del_state(state):
     for item in state[1:]: del item
-    for item in state[0]: del item
+    if isinstance(state[0], tuple):
+        for item in state[0]: del item
 
 
 ###### Main Agent Interface Loop
 async def agent_loop(shared_obj):
-    mouse_q, key_q, frame_q, event_end = shared_obj
+    input_ring, mouse_slot, frame_ring, event_end = shared_obj
 
     # print("gpu buffs test: loading buffs from disk")
     # buffs = t.load('/home/chris/Documents/agent_interface/100_buffs.list')
@@ -79,42 +113,81 @@ async def agent_loop(shared_obj):
 
     print("gpu render test: loading states from disk")
     states = t.load('/home/chris/Documents/agent_interface/100_states.list')
+    states = to_sparse(states)
     states = to_gpu(states)
-    states = iter(states)
 
-    z_buffer = t.empty(FRAME_SIZE, dtype=t.int32).cuda()
-    f_buffer = t.empty([*FRAME_SIZE,3], dtype=t.int32).cuda()
-    lock_buffer = t.empty(FRAME_SIZE, dtype=t.int32).cuda()
+    ## sprites referenced by id go to the device once, here; per frame only ids and node arrays are touched
+    store = AssetStore.load(ASSET_PATH) if os.path.exists(ASSET_PATH) else None
+    if store is not None: store.to_device('cuda')
+
+    ## uint8 RGB frames, the same layout the ring and the encoder take
+    f_buffer = t.empty([*FRAME_SIZE,3], dtype=t.uint8).cuda()
+    ## the previous frame, kept on the device to find the region each new frame changed; swapped with f_buffer per frame
+    prev_buffer = None
+    if PAINTER_RENDER: z_buffer = lock_buffer = None
+    else:
+        z_buffer = t.empty(FRAME_SIZE, dtype=z_dtype(states)).cuda()
+        lock_buffer = t.empty(FRAME_SIZE, dtype=t.int32).cuda()
+
+    states = iter(states)
 
     print('agent loop: waiting')
     # time.sleep(.5)
     print('agent loop: now running')
 
     ioloop = IOLoop.current()
+    pacer = FramePacer(options.agent_fps)
+    mouse_version = 0
+    ## (input_id, t_input, t_recv, t_step) of the last input consumed; every frame is tagged with it for latency tracing
+    trace = None
     while True:
 
-        ## can await mouse, key, or any other q to trigger agent update
+        ## renders at a fixed rate rather than once per event: everything that arrived since the last frame is one step
+        await pacer.wait()
+
+        ## both are reads of shared memory, no manager round-trip. clicks and keys arrive in order; moves are only the newest position
         try:
-            mouse_move = await get_blocking(mouse_q)
+            events = input_ring.get_all()
+            version, mouse_event = mouse_slot.read()
         except Exception as e:
             print('agent proc: caught exception', type(e), ' : ', e, '; raising')
             raise e
 
-        ## much lower latency to run these synchronously
+        moved = (version != mouse_version)
+        mouse_version = version
+        if not (events or moved or options.agent_idle_step): continue
+
+        consumed = events + [mouse_event] if moved else events
+        if consumed:
+            last = max(consumed, key=lambda event: event.t_recv)
+            trace = (last.input_id, last.t, last.t_recv, time.time())
+
         try: state = next(states)
         except: break
+        state = resolve_state(state, store, 'cuda')
+
+        if PAINTER_RENDER: t.ops.render_op.render_painter_kernel(*state, f_buffer)
+        else: t.ops.render_op.render_sparse_kernel(*state, z_buffer, f_buffer, lock_buffer)
+
+        ## the renderers redraw the whole buffer, so the changed region comes from a device-side compare with the last frame
+        dirty = None if prev_buffer is None else dirty_rect(f_buffer, prev_buffer)
 
-        t.ops.render_op.render_kernel(*state, z_buffer, f_buffer, lock_buffer)
-        f_buff_cpu = f_buffer.cpu().numpy()
-        frame_q.put_nowait(f_buff_cpu)
+        ## copy device framebuffer straight into the next shared-memory slot; no pickling, no manager hop
+        seq, slot = frame_ring.claim()
+        t.from_numpy(slot).copy_(f_buffer)
+        frame_ring.publish(seq, dirty=dirty, trace=trace)
+        pacer.frame_done()
 
-        await ioloop.run_in_executor(None, functools.partial(flush_q, mouse_q))
-        await ioloop.run_in_executor(None, functools.partial(print_loc, mouse_move))
+        if prev_buffer is None: prev_buffer = t.empty_like(f_buffer)
+        f_buffer, prev_buffer = prev_buffer, f_buffer
+
+        if moved: await ioloop.run_in_executor(None, functools.partial(print_loc, mouse_event.args))
 
     for state in states: del_state(state)
     del states
     del z_buffer
     del f_buffer
+    del prev_buffer
     del lock_buffer
     event_end.wait()
 
@@ -140,6 +213,8 @@ def handle_sig(sig, _):
 ## NOTE: inter-process pipes can break at the OS level - randomly - and only when submitting run_server to the executor.
 # If this happens, close all programs and kill all python processes manually - rebooting will not fix.
 def setup_run():
+    ## server options (e.g. --encoder, --quality) are parsed here and inherited by the server proc
+    tornado.options.parse_command_line()
     t.cuda.set_device(0)
 
     n_logi_cores = tornado.process.cpu_count()
@@ -157,6 +232,9 @@ def setup_run():
     print('Restricting torch to', thd_per_proc, 'threads per proc')
 
     man = mp.Manager()
+    frame_ring = FrameRing(FRAME_SIZE, n_slots=4, dtype=np.uint8)
+    mouse_slot = MouseSlot()
+    input_ring = InputRing()
 
     signal.signal(signal.SIGTERM, handle_sig)
     signal.signal(signal.SIGINT, handle_sig)
@@ -167,9 +245,10 @@ def setup_run():
         with man:
 
             ## if needed, we can register a LIFO queue with a custom Manager class
-            shared_obj = (man.Queue(), man.Queue(), man.Queue(), man.Event())
+            ## (click and key events in order, latest mouse position, frames, end event)
+            shared_obj = (input_ring, mouse_slot, frame_ring, man.Event())
 
-            proc = mp.Process(target=run_server.run_server, args=(shared_obj, n_srv_proc))
+            proc = mp.Process(target=server.run_server, args=(shared_obj, n_srv_proc))
             proc.start()
 
             ## run cuda on the main process - much faster than setting 'spawn' as start method
@@ -178,6 +257,10 @@ def setup_run():
             ioloop.set_default_executor(exec)
             ioloop.run_sync(functools.partial(agent_loop, shared_obj))
 
+        frame_ring.close()
+        mouse_slot.close()
+        input_ring.close()
+
     except Exception as e:
         print('main proc: caught exception', type(e), ' : ', e)
 
@@ -198,6 +281,11 @@ def setup_run():
             print('main proc: sent KILL to server proc')
         except: pass
 
+        print('main proc: releasing shared frame ring and input buffers')
+        frame_ring.close()
+        mouse_slot.close()
+        input_ring.close()
+
         print('main proc: shutting down object manager')
         try:
             man.shutdown()
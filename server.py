@@ -15,12 +15,21 @@ from tornado.process import task_id
 
 import os
 
-import server_handlers
+import server_handlers as handlers
+from frame_hub import FrameHub
+from latency_trace import LatencyTracker
+from encoders import get_encoder
 
 
+define('encoder', default='jpeg', help='default frame encoder: jpeg, turbojpeg, webp, png, raw or lz4')
+define('quality', default=None, type=int, help='default encoder quality (compression level for png and lz4)')
 
 
-def make_app(shared_obj):
+
+
+def make_app(shared_obj, frame_hub, tracker):
+    input_ring, mouse_slot, frame_ring, event_end = shared_obj
+    inputs = dict(input_ring=input_ring, mouse_slot=mouse_slot)
 
     app = Application(
         url='localhost',
@@ -28,12 +37,30 @@ def make_app(shared_obj):
         handlers=[
             (r'/', handlers.BaseView, dict(shared_obj=shared_obj)),
 
-            (r'/mouse/move', handlers.MouseMoveHandler),
-            (r'/mouse/click', handlers.MouseClickHandler),
+            (r'/mouse/move', handlers.MouseMoveHandler, inputs),
+            (r'/mouse/click', handlers.MouseClickHandler, inputs),
+
+            (r'/key/update', handlers.KeyHandler, inputs),
+
+            ## all input events over one websocket; the AJAX routes above remain as a fallback
+            (r'/input/ws', handlers.InputSocket, inputs),
+            ## batched input events, flushed by the page once per animation frame
+            (r'/input/batch', handlers.InputBatchHandler, inputs),
 
-            (r'/key/update', handlers.KeyHandler),
+            url(r'/state/update', handlers.SendUpdatedState, dict(frame_hub=frame_hub), name="get_frames"),
+            (r'/state/stats', handlers.StreamStatsHandler, dict(frame_hub=frame_hub)),
 
-            url(r'/state/update', handlers.SendUpdatedState, name="get_frames"),
+            ## input-to-photon latency: browsers report traces, /metrics summarises them per stage
+            (r'/metrics', handlers.MetricsHandler, dict(frame_hub=frame_hub, tracker=tracker)),
+            (r'/metrics/latency', handlers.LatencyReportHandler, dict(tracker=tracker)),
+
+            ## delta-tile stream onto a persistent canvas
+            (r'/tiles', handlers.CanvasView, dict(shared_obj=shared_obj, mode='tiles')),
+            url(r'/state/tiles', handlers.SendTiles, dict(frame_hub=frame_hub), name="get_tiles"),
+
+            ## binary websocket frame stream with acks
+            (r'/ws', handlers.CanvasView, dict(shared_obj=shared_obj, mode='ws')),
+            url(r'/state/ws', handlers.FrameSocket, dict(frame_hub=frame_hub), name="frame_socket"),
         ],
 
         template_path=os.path.join(os.path.dirname(__file__), 'templates'),
@@ -53,8 +80,13 @@ def run_server(shared_obj, n_srv_proc):
     ioloop = IOLoop.current()
     ioloop.set_default_executor(exec)
 
+    ## one reader of the frame ring for the whole server; every stream subscribes to the hub
+    input_ring, mouse_slot, frame_ring, event_end = shared_obj
+    frame_hub = FrameHub(frame_ring, get_encoder(options.encoder, options.quality))
+    frame_hub.start()
+
     port = 8888
-    app = make_app(shared_obj)
+    app = make_app(shared_obj, frame_hub, LatencyTracker())
     http_server = HTTPServer(app)
     http_server.listen(port)
 
@@ -1,8 +1,15 @@
-import functools
-import cv2
+import json
+import struct
+import time
+
+from encoders import get_encoder, encoding_id
+from stream_control import AdaptiveController, Viewport, write_buffer_size
+from tile_stream import TileClients
 
 from tornado.ioloop import IOLoop
+from tornado.locks import Condition
 from tornado.web import RequestHandler
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
 
 
 
@@ -11,61 +18,132 @@ from tornado.web import RequestHandler
 class BaseView(RequestHandler):
 
     def initialize(self, shared_obj):
-        BaseView.mouse_q, BaseView.key_q, BaseView.frame_q, BaseView.event_end = shared_obj
+        BaseView.input_ring, BaseView.mouse_slot, BaseView.frame_ring, BaseView.event_end = shared_obj
         BaseView.ioloop = IOLoop.current()
     
     def get(self):
         self.render('index.html')
 
+class CanvasView(BaseView):
+    ## canvas page driven by static/getstate.js; mode picks the stream it pulls from
+
+    def initialize(self, shared_obj, mode):
+        super().initialize(shared_obj)
+        self.mode = mode
+
+    def get(self):
+        self.render('canvas.html', mode=self.mode)
 
 
 
 
 
-def put_on_blocking_q(queue, value):
-    try: queue.put_nowait(value)
-    except Exception as e:
-        print('MouseHandler: on queue.put_nowait, caught exception', type(e), ' : ', e)
-        # print('raising', e)
-        # raise e
 
 def str2bool(str):
     if str == 'false': return False
     if str == 'true': return True
 
-class MouseMoveHandler(RequestHandler):
+## every input path (the AJAX handlers and the input socket) goes through these, so they all feed the agent the same way.
+## moves only overwrite the shared latest-position slot; clicks and keys go in order through the shared input ring.
+## both are plain stores into shared memory, done right here on the IOLoop thread
+## t is the browser timestamp of the event in unix seconds and input_id its browser id, when the client sends them
+def push_mouse_move(mouse_slot, x, y, t=0.0, input_id=0):
+    mouse_slot.write(int(x), int(y), float(t), int(input_id))
+
+def push_mouse_click(input_ring, button, t=0.0, input_id=0):
+    input_ring.put_click(int(button), float(t), int(input_id))
+
+def push_key(input_ring, key, shiftKey, ctrlKey, altKey, t=0.0, input_id=0):
+    input_ring.put_key(str(key), bool(shiftKey), bool(ctrlKey), bool(altKey), float(t), int(input_id))
+
+def push_event(input_ring, mouse_slot, kind, *args, t=0.0, input_id=0):
+    ## one event as the browser sends it; kind picks the push and the shared object it writes to
+    if kind == 'm': push_mouse_move(mouse_slot, *args, t=t, input_id=input_id)
+    elif kind == 'c': push_mouse_click(input_ring, *args, t=t, input_id=input_id)
+    elif kind == 'k': push_key(input_ring, *args, t=t, input_id=input_id)
+    else: raise ValueError('unknown input event kind: ' + str(kind))
+
+def push_batch(input_ring, mouse_slot, events):
+    ## events as [kind, t, input_id, *args] in the order they happened, e.g. ["m", t, id, x, y]; expanded into the
+    ## single-event pushes
+    for kind, t, input_id, *args in events:
+        push_event(input_ring, mouse_slot, kind, *args, t=t, input_id=input_id)
+
+
+class InputHandler(RequestHandler):
+    ## the shared input objects come with the route, so input works before any page has been loaded
+
+    def initialize(self, input_ring, mouse_slot):
+        self.input_ring = input_ring
+        self.mouse_slot = mouse_slot
+
+class MouseMoveHandler(InputHandler):
 
     # /mouse/move POST
-    async def post(self):
+    def post(self):
 
         x = int( self.request.arguments['x'][0].decode() )
         y = int( self.request.arguments['y'][0].decode() )
 
-        vals = (x,y)
-        await BaseView.ioloop.run_in_executor(None, functools.partial(put_on_blocking_q, BaseView.mouse_q, vals) )
+        push_mouse_move(self.mouse_slot, x, y)
 
-class MouseClickHandler(RequestHandler):
+class MouseClickHandler(InputHandler):
 
     # /mouse/click POST
-    async def post(self):
+    def post(self):
 
         button = int( self.request.arguments['button'][0].decode() )
 
-        vals = (button,)
-        await BaseView.ioloop.run_in_executor(None, functools.partial(put_on_blocking_q, BaseView.mouse_q, vals) )
+        push_mouse_click(self.input_ring, button)
 
-class KeyHandler(RequestHandler):
+class KeyHandler(InputHandler):
 
     # /key/update POST
-    async def post(self):
+    def post(self):
 
         shiftKey = str2bool( self.request.arguments['shiftKey'][0].decode() )
         ctrlKey = str2bool( self.request.arguments['ctrlKey'][0].decode() )
         altKey = str2bool( self.request.arguments['altKey'][0].decode() )
         Key = self.request.arguments['Key'][0].decode()
 
-        vals = (Key, shiftKey, ctrlKey, altKey)
-        await BaseView.ioloop.run_in_executor(None, functools.partial(put_on_blocking_q, BaseView.key_q, vals) )
+        push_key(self.input_ring, Key, shiftKey, ctrlKey, altKey)
+
+
+class InputBatchHandler(InputHandler):
+
+    # /input/batch POST
+    ## JSON array of events, each [kind, t, id, *args] with t the browser time in unix seconds and id its input id:
+    ##     ["m", t, id, x, y]   ["c", t, id, button]   ["k", t, id, key, shiftKey, ctrlKey, altKey]
+    def post(self):
+        try: events = json.loads(self.request.body)
+        except Exception as e:
+            self.send_error(400, reason=str(e))
+            return
+
+        try: push_batch(self.input_ring, self.mouse_slot, events)
+        except Exception as e:
+            print('InputBatchHandler: on push_batch, caught exception', type(e), ' : ', e)
+            self.send_error(400, reason=str(e))
+
+
+class InputSocket(WebSocketHandler):
+
+    def initialize(self, input_ring, mouse_slot):
+        self.input_ring = input_ring
+        self.mouse_slot = mouse_slot
+
+    # /input/ws
+    ## one persistent socket per page carrying input events as JSON arrays, one event per message:
+    ##     ["m", x, y]   ["c", button]   ["k", key, shiftKey, ctrlKey, altKey]
+    ## or a batch, as taken by /input/batch:   ["b", [[kind, t, id, *args], ...]]
+    ## messages are handled one at a time on the IOLoop thread, so events reach the agent in the order they were sent
+    def on_message(self, message):
+        try:
+            kind, *args = json.loads(message)
+            if kind == 'b': push_batch(self.input_ring, self.mouse_slot, *args)
+            else: push_event(self.input_ring, self.mouse_slot, kind, *args)
+        except Exception as e:
+            print('InputSocket: on message, caught exception', type(e), ' : ', e)
 
 
 
@@ -73,52 +151,297 @@ class KeyHandler(RequestHandler):
 
 
 
-def get_and_proc(frame_q):
-    ## blocking get runs on aux thread
-    try:
-        frame = frame_q.get()
-        success, blob = cv2.imencode('.jpg', frame)
-        if success: message = bytes(blob)
-        else: message = None
-        return message
-    except Exception as e:
-        print('UpdatedStateHandler: on frame_q.get, caught exception', type(e), ' : ', e)
-        # print('raising', e)
-        # raise e
+## multipart framing of /state/update. Each part goes out as one buffer: the constant head for its content type
+## (built once), the per-frame header lines, the encoded frame and the boundary, joined in a single copy.
+## Per-frame headers give the frame seq and when it was rendered, encoded and sent, as unix seconds, and the input trace
+## of the frame: id, browser time, server receive time and agent step time of the last input it reflects
+FRAME_BND = '--framebnd'
+PART_TAIL = (FRAME_BND + '\n').encode()
+PART_LINES = (b'X-Frame-Seq: %i\r\nX-Frame-Rendered: %.6f\r\nX-Frame-Encoded: %.6f\r\nX-Frame-Sent: %.6f\r\n'
+              b'X-Input-Trace: %i %.6f %.6f %.6f\r\nX-Frames-Dropped: %i\r\nContent-length: %i\r\n\r\n')
+_part_heads = dict()
+
+def part_head(content_type):
+    head = _part_heads.get(content_type)
+    if head is None: head = _part_heads[content_type] = ('Content-type: %s\r\n' % content_type).encode()
+    return head
+
+
+def viewport_args(handler):
+    ## w=<css px>, h=<css px>, dpr=<device pixel ratio>, roi=<y0,x0,y1,x1 frame px>; None without w and h
+    return Viewport.from_args(*(handler.get_argument(arg, None) for arg in ('w', 'h', 'dpr', 'roi')))
+
 
 class SendUpdatedState(RequestHandler):
 
+    def initialize(self, frame_hub):
+        self.frame_hub = frame_hub
+
     # /state/update GET
+    ## optional args: enc=<encoder name> and q=<quality> pick the encoding for this stream; default is the server's.
+    ## adapt=0 turns off adaptive quality and resolution for this stream. w, h, dpr and roi give the client's viewport;
+    ## frames are cropped to roi and downscaled to fit it before encoding
     async def get(self):
-        frame_bnd = "--framebnd"
+        try:
+            enc = self.get_argument('enc', None)
+            if enc is None: encoder = self.frame_hub.encoder
+            else: encoder = get_encoder(enc, self.get_argument('q', None))
+            viewport = viewport_args(self)
+        except ValueError as e:
+            self.send_error(400, reason=str(e))
+            return
 
         self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate, pre-check=0, post-check=0, max-age=0')
         self.set_header('Connection', 'close')
-        self.set_header('Content-Type', 'multipart/x-mixed-replace;boundary=' + frame_bnd)
+        self.set_header('Content-Type', 'multipart/x-mixed-replace;boundary=' + FRAME_BND)
         self.set_header('Pragma', 'no-cache')
-        self.write(frame_bnd + '\n')
+        self.write(PART_TAIL)
+
+        ## each connection keeps its own cursor into the hub; start from the newest frame
+        cursor = max(0, self.frame_hub.latest_seq - 1)
+
+        ## degrade quality, then resolution, while this client's flushes run late
+        controller = None
+        if self.get_argument('adapt', '1') != '0': controller = AdaptiveController()
+
+        ## latest-frame-wins: next() hands back the newest frame, stale ones are skipped and counted here
+        stats = self.frame_hub.subscribe('mjpeg', self.request.remote_ip)
+        delivered = 0
 
         try:
 
             while True:
-                message = await BaseView.ioloop.run_in_executor(None, functools.partial(get_and_proc, BaseView.frame_q))
+                entry = await self.frame_hub.next(cursor)
+                cursor = entry.seq
+
+                level_encoder = encoder if controller is None else controller.encoder(encoder)
+                if viewport is not None: level_encoder = viewport.encoder(level_encoder, entry.frame.shape)
+                message = await self.frame_hub.encode(entry, level_encoder)
 
                 if message is not None and message is not False:
-                    self.write("Content-type: image/jpeg\r\n")
-                    self.write("Content-length: %s\r\n\r\n" % len(message))
-                    self.write(message)
-                    self.write(frame_bnd + '\n')
-                    await self.flush()
+                    stats.count(delivered, entry.seq)
+                    delivered = entry.seq
+
+                    ## a single bytes chunk is handed to the IOStream as is, so the join is the only copy of the frame
+                    lines = PART_LINES % (entry.seq, entry.t_render, entry.t_encoded.get(level_encoder.key, 0.0), time.time(),
+                                          *entry.trace, stats.dropped, len(message))
+                    self.write(b''.join(( part_head(level_encoder.content_type), lines, message, PART_TAIL )))
+
+                    start = time.monotonic()
+                    flushed = self.flush()
+                    buffered = write_buffer_size(self)
+                    await flushed
+                    if controller is not None: controller.update(time.monotonic() - start, buffered)
 
         except Exception as e:
             print('UpdatedStateHandler: caught exception:', type(e), ' : ', e)
             # print('raising', e)
             # raise e
+        finally:
+            self.frame_hub.unsubscribe(stats)
+
+
 
+def set_frame_headers(handler, entry, t_encoded, dropped):
+    ## same per-frame timing as the multipart part headers, on a whole response
+    handler.set_header('X-Frame-Seq', str(entry.seq))
+    handler.set_header('X-Frame-Rendered', '%.6f' % entry.t_render)
+    handler.set_header('X-Frame-Encoded', '%.6f' % t_encoded)
+    handler.set_header('X-Frame-Sent', '%.6f' % time.time())
+    handler.set_header('X-Input-Trace', '%i %.6f %.6f %.6f' % entry.trace)
+    handler.set_header('X-Frames-Dropped', str(dropped))
 
 
+class SendTiles(RequestHandler):
 
+    ## per-browser record of what it was last sent, shared by all its polls
+    clients = TileClients()
 
+    def initialize(self, frame_hub):
+        self.frame_hub = frame_hub
 
+    # /state/tiles GET
+    ## long-poll for the tiles that changed since the frame at cursor. args: client=<id>, cursor=<last applied seq>, q=<quality>
+    async def get(self):
+        try:
+            client_id = self.get_argument('client')
+            cursor = int(self.get_argument('cursor', '0'))
+            quality = int(self.get_argument('q', '85'))
+        except Exception as e:
+            self.send_error(400, reason=str(e))
+            return
+
+        client = SendTiles.clients.get(self.frame_hub, client_id, self.request.remote_ip)
+
+        ## the client's canvas is not what we last sent it; send a keyframe of the newest frame
+        resync = (cursor != client.last_seq)
+        if resync: cursor = max(0, self.frame_hub.latest_seq - 1)
+
+        try:
+            entry = await self.frame_hub.next(cursor)
+            packet, t_encoded = await SendTiles.clients.packet(self.frame_hub, client, entry, resync, quality=quality)
+        except Exception as e:
+            print('SendTiles: caught exception:', type(e), ' : ', e)
+            self.send_error(500)
+            return
+
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
+        self.set_header('Content-Type', 'application/octet-stream')
+        set_frame_headers(self, entry, t_encoded, client.stats.dropped)
+        self.finish(packet)
+
+
+
+## binary frame message header, little-endian:
+##     magic b'FRM2' | seq u32 | t_render f64 | t_encode f64 | t_send f64 | dropped u32 | encoding u8 | pad u8
+##     | h u16 | w u16 | dirty y0,x0,y1,x1 u16 | input_id i64 | t_input f64 | t_recv f64 | t_step f64
+## followed by the encoded frame. times are unix seconds; dirty is the region changed since the previous frame sent on
+## this socket, in frame pixels (the whole frame after skipped or undecodable frames).
+## input_id and the last three times trace the last input the frame reflects (t_input is on the browser's clock)
+FRAME_HEAD = struct.Struct('<4sIdddIBxHHHHHHqddd')
+FRAME_MAGIC = b'FRM2'
+## encodings static/framesocket.js can draw (its FRAME_MIME plus raw); others are refused on open
+SOCKET_ENCODINGS = ('jpeg', 'turbojpeg', 'webp', 'png', 'raw', 'jpeg_strips')
+
+class FrameSocket(WebSocketHandler):
+
+    def initialize(self, frame_hub):
+        self.frame_hub = frame_hub
+
+    # /state/ws
+    ## same args as /state/update, plus inflight=<max unacked frames>. client acks each drawn frame with {"ack": seq},
+    ## and each frame it failed to decode with {"ack": seq, "failed": true}, and reports a changed viewport with {"viewport": {"w":, "h":, "dpr":, "roi": [y0, x0, y1, x1]}}
+    def open(self):
+        self.acked = 0
+        self.in_flight = list()
+        self.ack_cond = Condition()
+        self.closed = False
+        ## set when the client could not draw a frame; the next frame's dirty rect is then the whole frame
+        self.resync = False
+
+        try:
+            enc = self.get_argument('enc', None)
+            if enc is None: self.encoder = self.frame_hub.encoder
+            else: self.encoder = get_encoder(enc, self.get_argument('q', None))
+            self.max_in_flight = max(1, int(self.get_argument('inflight', '2')))
+            self.viewport = viewport_args(self)
+            if self.encoder.name not in SOCKET_ENCODINGS: raise ValueError('encoding not drawable by the page: ' + self.encoder.name)
+        except ValueError as e:
+            self.close(1003, str(e))
+            return
+
+        self.controller = None
+        if self.get_argument('adapt', '1') != '0': self.controller = AdaptiveController()
+
+        self.stats = self.frame_hub.subscribe('ws', self.request.remote_ip)
+        IOLoop.current().spawn_callback(self.send_loop)
+
+    def on_message(self, message):
+        try:
+            message = json.loads(message)
+            if 'viewport' in message:
+                v = message['viewport']
+                self.viewport = Viewport.from_args(v.get('w'), v.get('h'), v.get('dpr'), v.get('roi'))
+                return
+            ack = int(message['ack'])
+        except Exception as e:
+            print('FrameSocket: on message, caught exception', type(e), ' : ', e)
+            return
+        if message.get('failed'):
+            print('FrameSocket: client could not decode frame', ack)
+            self.resync = True
+
+        ## acks are cumulative: everything up to seq has been shown
+        self.acked = max(self.acked, ack)
+        self.in_flight = [seq for seq in self.in_flight if seq > self.acked]
+        self.ack_cond.notify_all()
+
+    def on_close(self):
+        self.closed = True
+        self.ack_cond.notify_all()
+        if hasattr(self, 'stats'): self.frame_hub.unsubscribe(self.stats)
+
+    async def send_loop(self):
+        cursor = max(0, self.frame_hub.latest_seq - 1)
+        delivered = 0
+
+        try:
+            while not self.closed:
+
+                ## bounded frames in flight: wait for the client to show what it already has
+                while len(self.in_flight) >= self.max_in_flight and not self.closed:
+                    await self.ack_cond.wait()
+                if self.closed: break
+
+                entry = await self.frame_hub.next(cursor)
+                cursor = entry.seq
+
+                encoder = self.encoder if self.controller is None else self.controller.encoder(self.encoder)
+                if self.viewport is not None: encoder = self.viewport.encoder(encoder, entry.frame.shape)
+                message = await self.frame_hub.encode(entry, encoder)
+                if message is None: continue
+
+                self.stats.count(delivered, entry.seq)
+                dirty = entry.dirty_since(-1 if self.resync else delivered)
+                self.resync = False
+                delivered = entry.seq
+
+                h, w = encoder.out_size(entry.frame.shape)
+                t_send = time.time()
+                head = FRAME_HEAD.pack(FRAME_MAGIC, entry.seq, entry.t_render, entry.t_encoded.get(encoder.key, t_send), t_send,
+                                       self.stats.dropped, encoding_id(encoder.name), h, w, *dirty, *entry.trace)
 
+                start = time.monotonic()
+                self.in_flight.append(entry.seq)
+                await self.write_message(b''.join((head, message)), binary=True)
+                if self.controller is not None: self.controller.update(time.monotonic() - start, 0)
 
+        except WebSocketClosedError: pass
+        except Exception as e:
+            print('FrameSocket: caught exception:', type(e), ' : ', e)
+
+
+
+class StreamStatsHandler(RequestHandler):
+
+    def initialize(self, frame_hub):
+        self.frame_hub = frame_hub
+
+    # /state/stats GET
+    ## JSON of per-stream sent and dropped frame counts
+    def get(self):
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
+        self.write(self.frame_hub.stats())
+
+
+
+class MetricsHandler(RequestHandler):
+
+    def initialize(self, frame_hub, tracker):
+        self.frame_hub = frame_hub
+        self.tracker = tracker
+
+    # /metrics GET
+    ## JSON of input-to-photon latency per stage (n, mean, p50, p95, p99 in ms; see latency_trace.py) and the stream stats
+    def get(self):
+        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
+        self.write(dict(
+            traces=self.tracker.n_traces,
+            latency_ms=self.tracker.summary(),
+            frames=self.frame_hub.stats(),
+        ))
+
+
+class LatencyReportHandler(RequestHandler):
+
+    def initialize(self, tracker):
+        self.tracker = tracker
+
+    # /metrics/latency POST
+    ## JSON array of traces from browsers, as taken by LatencyTracker.add
+    def post(self):
+        try:
+            for trace in json.loads(self.request.body): self.tracker.add(trace)
+        except Exception as e:
+            print('LatencyReportHandler: on trace, caught exception', type(e), ' : ', e)
+            self.send_error(400, reason=str(e))
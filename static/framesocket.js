@@ -0,0 +1,95 @@
+// Binary frame stream from /state/ws. Each message is a frame header followed by the encoded frame:
+//     'FRM2' | seq u32 | t_render f64 | t_encode f64 | t_send f64 | dropped u32 | encoding u8 | pad u8
+//     | h u16 | w u16 | dirty y0,x0,y1,x1 u16 | input_id i64 | t_input f64 | t_input_recv f64 | t_step f64
+// Every frame is acked with {"ack": seq} once drawn, or with {"ack": seq, "failed": true} if it could not be decoded,
+// so a bad frame never stalls the stream; the server keeps only a few unacked frames in flight.
+// The page's viewport is sent on open and on resize, and the server encodes frames at that size.
+
+// encoding ids, in the order of encoders.ENCODERS
+const FRAME_MIME = ["image/jpeg", "image/jpeg", "image/webp", "image/png", null, null, "image/jpeg"];
+const ENC_RAW = 4;
+const FRAME_HEAD_SIZE = 82;
+
+var frameSocket = {
+    ws: null,
+    retrySleepTime: 500,
+    last_seq: 0,
+
+    open: function() {
+        var proto = (window.location.protocol === "https:") ? "wss://" : "ws://";
+        var search = window.location.search;
+        search += (search ? "&" : "?") + viewport.query();
+        var ws = new WebSocket(proto + window.location.host + "/state/ws" + search);
+        ws.binaryType = "arraybuffer";
+        ws.onmessage = frameSocket.onMessage;
+        ws.onclose = function() { window.setTimeout(frameSocket.open, frameSocket.retrySleepTime); };
+        frameSocket.ws = ws;
+    },
+
+    onMessage: function(event) {
+        var t_recv = Date.now() / 1000;
+        var buffer = event.data;
+        var view = new DataView(buffer);
+
+        var frame = {
+            seq: view.getUint32(4, true),
+            t_render: view.getFloat64(8, true),
+            t_encode: view.getFloat64(16, true),
+            t_send: view.getFloat64(24, true),
+            dropped: view.getUint32(32, true),
+            encoding: view.getUint8(36),
+            h: view.getUint16(38, true),
+            w: view.getUint16(40, true),
+            dirty: [view.getUint16(42, true), view.getUint16(44, true), view.getUint16(46, true), view.getUint16(48, true)],
+            input_id: Number(view.getBigInt64(50, true)),
+            t_input: view.getFloat64(58, true),
+            t_input_recv: view.getFloat64(66, true),
+            t_step: view.getFloat64(74, true),
+        };
+        var payload = new Uint8Array(buffer, FRAME_HEAD_SIZE);
+
+        frameSocket.decode(frame, payload).then(function(image) {
+            shapeDraw.c.drawImage(image, 0, 0, shapeDraw.canvas.width, shapeDraw.canvas.height);
+            if (image.close) image.close();
+
+            frameSocket.last_seq = frame.seq;
+            frameStats.record(frame, t_recv);
+            frameSocket.ack(frame.seq, false);
+        }, function(e) {
+            console.log("frameSocket: could not decode frame", frame.seq, e);
+            frameSocket.ack(frame.seq, true);
+        });
+    },
+
+    ack: function(seq, failed) {
+        var ws = frameSocket.ws;
+        if (ws === null || ws.readyState !== WebSocket.OPEN) return;
+        ws.send(JSON.stringify(failed ? {ack: seq, failed: true} : {ack: seq}));
+    },
+
+    sendViewport: function() {
+        var ws = frameSocket.ws;
+        if (ws === null || ws.readyState !== WebSocket.OPEN) return;
+        var v = viewport.get();
+        if (v.roi !== undefined) v.roi = viewport.roi;
+        ws.send(JSON.stringify({viewport: v}));
+    },
+
+    decode: function(frame, payload) {
+        if (frame.encoding === ENC_RAW) {
+            // RGB24 rows -> RGBA ImageData
+            var rgba = new Uint8ClampedArray(frame.w * frame.h * 4);
+            for (var i = 0, j = 0; i < payload.length; i += 3, j += 4) {
+                rgba[j] = payload[i];
+                rgba[j+1] = payload[i+1];
+                rgba[j+2] = payload[i+2];
+                rgba[j+3] = 255;
+            }
+            return createImageBitmap(new ImageData(rgba, frame.w, frame.h));
+        }
+
+        var mime = FRAME_MIME[frame.encoding];
+        if (!mime) return Promise.reject("unsupported encoding " + frame.encoding);
+        return createImageBitmap(new Blob([payload], {type: mime}));
+    },
+};
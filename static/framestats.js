@@ -0,0 +1,102 @@
+// Per-frame timing recorded by every stream that can see it: the binary frame socket (in its frame header) and the
+// tile stream (in X-Frame-* response headers). Times are unix seconds; t_render, t_encode and t_send come from the
+// server's clock and t_recv, t_shown from this page's.
+//
+// Glass-to-glass latency is t_shown - t_render. Across machines this includes the clock offset between them, which
+// frameStats estimates as the smallest t_recv - t_send seen (an upper bound: offset plus the fastest network delay).
+// Set frameStats.onFrame to a function to get each record as it is made, e.g. to ship them somewhere.
+//
+// Input-to-photon tracing: frames carry the id of the last input the agent consumed before rendering them. The first
+// frame shown for each input this page sent is reported, with its full trace, to /metrics/latency once a second.
+
+var frameStats = {
+    max_records: 600,
+    records: [],
+
+    last_seq: 0,
+    shown: 0,
+    // frames the server skipped for this page, as counted by the server
+    server_dropped: 0,
+    // gaps in the seqs this page drew
+    seq_gaps: 0,
+    clock_offset: null,
+
+    onFrame: null,
+
+    last_traced: 0,
+    traces: [],
+    report_interval: 1000,
+
+    // meta: {seq, t_render, t_encode, t_send, dropped, input_id, t_input, t_input_recv, t_step};
+    // t_recv is when the frame arrived, before decoding
+    record: function(meta, t_recv) {
+        var t_shown = Date.now() / 1000;
+
+        if (frameStats.last_seq > 0 && meta.seq > frameStats.last_seq + 1) frameStats.seq_gaps += meta.seq - frameStats.last_seq - 1;
+        frameStats.last_seq = meta.seq;
+        frameStats.shown += 1;
+        frameStats.server_dropped = meta.dropped;
+
+        var offset = t_recv - meta.t_send;
+        if (frameStats.clock_offset === null || offset < frameStats.clock_offset) frameStats.clock_offset = offset;
+
+        var rec = {
+            seq: meta.seq, t_render: meta.t_render, t_encode: meta.t_encode, t_send: meta.t_send,
+            t_recv: t_recv, t_shown: t_shown, latency: t_shown - meta.t_render,
+        };
+        frameStats.records.push(rec);
+        if (frameStats.records.length > frameStats.max_records) frameStats.records.shift();
+
+        if (typeof frameStats.onFrame === "function") frameStats.onFrame(rec);
+
+        if (meta.input_id > frameStats.last_traced && window.inputBatch && inputBatch.isOwn(meta.input_id)) {
+            frameStats.last_traced = meta.input_id;
+            frameStats.traces.push({
+                input_id: meta.input_id, seq: meta.seq,
+                t_input: meta.t_input, t_recv: meta.t_input_recv, t_step: meta.t_step,
+                t_render: meta.t_render, t_encode: meta.t_encode, t_send: meta.t_send,
+                t_arrive: t_recv, t_shown: t_shown, clock_offset: frameStats.clock_offset,
+            });
+        }
+    },
+
+    reportTraces: function() {
+        if (frameStats.traces.length === 0) return;
+        var traces = frameStats.traces;
+        frameStats.traces = [];
+        $.ajax({url: "/metrics/latency", type: "POST", contentType: "application/json", data: JSON.stringify(traces)});
+    },
+
+    percentile: function(values, p) {
+        if (values.length === 0) return null;
+        var sorted = values.slice().sort(function(a, b) { return a - b; });
+        return sorted[Math.min(sorted.length - 1, Math.floor(p / 100 * sorted.length))];
+    },
+
+    // latencies in ms over the kept records; *_sync subtracts the estimated clock offset
+    summary: function() {
+        var offset = frameStats.clock_offset || 0;
+        var latency = frameStats.records.map(function(r) { return 1000 * r.latency; });
+        var encode = frameStats.records.map(function(r) { return 1000 * (r.t_encode - r.t_render); });
+        var network = frameStats.records.map(function(r) { return 1000 * (r.t_recv - r.t_send - offset); });
+        var decode = frameStats.records.map(function(r) { return 1000 * (r.t_shown - r.t_recv); });
+        var latency_p50 = frameStats.percentile(latency, 50);
+
+        return {
+            shown: frameStats.shown,
+            server_dropped: frameStats.server_dropped,
+            seq_gaps: frameStats.seq_gaps,
+            clock_offset_ms: 1000 * offset,
+            latency_p50: latency_p50,
+            latency_p95: frameStats.percentile(latency, 95),
+            latency_sync_p50: (latency_p50 === null) ? null : latency_p50 - 1000 * offset,
+            encode_p50: frameStats.percentile(encode, 50),
+            network_sync_p50: frameStats.percentile(network, 50),
+            decode_p50: frameStats.percentile(decode, 50),
+        };
+    },
+};
+
+$( function() {
+    window.setInterval(frameStats.reportTraces, frameStats.report_interval);
+} );
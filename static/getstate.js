@@ -4,11 +4,31 @@ $( function() {
 
     $("#document").one("", shapeDraw.setup() );
 
-    stateGetter.poll();
+    // STREAM_MODE is set by the page template; 'tiles' pulls delta tiles, 'ws' opens the binary frame socket
+    if (window.STREAM_MODE === "tiles") tileGetter.poll();
+    else if (window.STREAM_MODE === "ws") frameSocket.open();
+    else stateGetter.poll();
 
 });
 
 
+// What this page displays, sent to the server so it encodes frames at the size they are shown
+var viewport = {
+    // optional [y0, x0, y1, x1] region of the frame to show, in frame pixels
+    roi: null,
+
+    get: function() {
+        var v = {w: window.innerWidth, h: window.innerHeight, dpr: window.devicePixelRatio || 1};
+        if (viewport.roi !== null) v.roi = viewport.roi.join(",");
+        return v;
+    },
+
+    query: function() {
+        return $.param(viewport.get());
+    },
+};
+
+
 const M_SEP = ";-MSEP-;";
 const T_SEP = ";-TYPE-;";
 
@@ -97,6 +117,89 @@ var stateGetter = {
 
 
 
+// Delta-tile stream from /state/tiles. Each response is a binary packet of changed tiles (see tile_stream.py):
+//     header:  'TILE' | seq u32 | n_tiles u32 | frame_h u16 | frame_w u16 | keyframe u8 | pad u8
+//     n_tiles x (y u16 | x u16 | h u16 | w u16 | nbytes u32), then the tile JPEGs in the same order
+var tileGetter = {
+    errorSleepTime: 50,
+    max_errorSleepTime: 4000,
+
+    // random id so the server can track what this page was last sent
+    client: Math.random().toString(36).slice(2),
+    cursor: 0,
+
+    poll: function() {
+        var xhr = new XMLHttpRequest();
+        xhr.open("GET", "/state/tiles?client=" + tileGetter.client + "&cursor=" + tileGetter.cursor, true);
+        xhr.responseType = "arraybuffer";
+        xhr.onload = function() {
+            if (xhr.status !== 200) { tileGetter.onError(); return; }
+            tileGetter.onPacket(xhr.response, tileGetter.frameMeta(xhr), Date.now() / 1000);
+        };
+        xhr.onerror = tileGetter.onError;
+        xhr.send(null);
+    },
+
+    // per-frame timing from the X-Frame-* response headers, for frameStats
+    frameMeta: function(xhr) {
+        var trace = (xhr.getResponseHeader("X-Input-Trace") || "0 0 0 0").split(" ");
+        return {
+            input_id: parseInt(trace[0]),
+            t_input: parseFloat(trace[1]),
+            t_input_recv: parseFloat(trace[2]),
+            t_step: parseFloat(trace[3]),
+            seq: parseInt(xhr.getResponseHeader("X-Frame-Seq")),
+            t_render: parseFloat(xhr.getResponseHeader("X-Frame-Rendered")),
+            t_encode: parseFloat(xhr.getResponseHeader("X-Frame-Encoded")),
+            t_send: parseFloat(xhr.getResponseHeader("X-Frame-Sent")),
+            dropped: parseInt(xhr.getResponseHeader("X-Frames-Dropped")),
+        };
+    },
+
+    onPacket: function(buffer, meta, t_recv) {
+        var view = new DataView(buffer);
+        var seq = view.getUint32(4, true);
+        var n_tiles = view.getUint32(8, true);
+        var frame_h = view.getUint16(12, true);
+        var frame_w = view.getUint16(14, true);
+
+        var head = 18;
+        var offs = head + n_tiles * 12;
+        var draws = [];
+        for (var i = 0; i < n_tiles; i++) {
+            var t = head + i * 12;
+            var y = view.getUint16(t, true);
+            var x = view.getUint16(t + 2, true);
+            var nbytes = view.getUint32(t + 8, true);
+
+            var blob = new Blob([new Uint8Array(buffer, offs, nbytes)], {type: "image/jpeg"});
+            offs += nbytes;
+            draws.push( createImageBitmap(blob).then( (function(x, y) {
+                return function(bitmap) { shapeDraw.draw_tile(bitmap, x, y, frame_w, frame_h); };
+            })(x, y) ) );
+        }
+
+        // apply the whole packet before asking for the next, so tiles from consecutive frames never interleave
+        Promise.all(draws).then(function() {
+            tileGetter.cursor = seq;
+            tileGetter.errorSleepTime = 50;
+            shapeDraw.present_tiles();
+            frameStats.record(meta, t_recv);
+            tileGetter.poll();
+        }, tileGetter.onError);
+    },
+
+    onError: function() {
+        // cursor 0 makes the server send a keyframe on the next poll
+        tileGetter.cursor = 0;
+        tileGetter.errorSleepTime = Math.min(tileGetter.errorSleepTime*2, tileGetter.max_errorSleepTime);
+        window.setTimeout(tileGetter.poll, tileGetter.errorSleepTime);
+    },
+};
+
+
+
+
 var shapeDraw = {
     // for each shape-drawing fn, the 'data' argument is a string.
     // fields within the 'data' string are space-separated
@@ -111,19 +214,26 @@ var shapeDraw = {
         console.log("shapeDraw.setup called");
 
         const canvas = document.querySelector('canvas');
-        canvas.width = innerWidth;
-        canvas.height = innerHeight;
         shapeDraw.canvas = canvas;
-
         shapeDraw.c = canvas.getContext('2d');
+        shapeDraw.size_canvas();
 
         window.addEventListener('resize', shapeDraw.resizeCanvas, false);
     },
 
+    // backing store in device pixels, so frames encoded for this viewport are drawn 1:1
+    size_canvas: function() {
+        var dpr = window.devicePixelRatio || 1;
+        shapeDraw.canvas.style.width = window.innerWidth + "px";
+        shapeDraw.canvas.style.height = window.innerHeight + "px";
+        shapeDraw.canvas.width = Math.round(window.innerWidth * dpr);
+        shapeDraw.canvas.height = Math.round(window.innerHeight * dpr);
+    },
+
     resizeCanvas: function () {
         console.log(" resizeCanvas called ")
-        shapeDraw.c.width = window.innerWidth;
-        shapeDraw.c.height = window.innerHeight;
+        shapeDraw.size_canvas();
+        if (window.STREAM_MODE === "ws") frameSocket.sendViewport();
     },
 
     // helper to apply JSON.parse to each item in an array in-place
@@ -209,6 +319,27 @@ var shapeDraw = {
         }
     },
 
+    // tiles composite at frame resolution onto a persistent offscreen canvas, which is then drawn scaled to the page
+    frame_canvas: null,
+
+    draw_tile: function(bitmap, x, y, frame_w, frame_h) {
+        var fc = shapeDraw.frame_canvas;
+        if (fc === null || fc.width !== frame_w || fc.height !== frame_h) {
+            fc = document.createElement('canvas');
+            fc.width = frame_w;
+            fc.height = frame_h;
+            shapeDraw.frame_canvas = fc;
+        }
+        fc.getContext('2d').drawImage(bitmap, x, y);
+        bitmap.close();
+    },
+
+    present_tiles: function() {
+        var fc = shapeDraw.frame_canvas;
+        if (fc === null) return;
+        shapeDraw.c.drawImage(fc, 0, 0, shapeDraw.canvas.width, shapeDraw.canvas.height);
+    },
+
     draw_frame: function(frame_data) {
         console.log("draw_frame called");
 
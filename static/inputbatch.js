@@ -0,0 +1,45 @@
+// Buffers input events and sends them together, once per animation frame (or every interval ms if interval > 0).
+// Each event keeps the time it happened, in unix seconds, and an input id for latency tracing:
+//     ["m", t, id, x, y]   ["c", t, id, button]   ["k", t, id, key, shiftKey, ctrlKey, altKey]
+// Ids count up from a random per-page base, so frames can be matched to this page's own inputs (see framestats.js).
+// A batch goes over the input socket when it is open, else as a POST to /input/batch; the server expands it in order.
+
+var inputBatch = {
+    interval: 0,
+    events: [],
+    scheduled: false,
+
+    id_base: Math.floor(Math.random() * (1 << 20)) * 4294967296,
+    n_sent: 0,
+
+    // true if input_id is one this page sent
+    isOwn: function(input_id) {
+        return input_id > inputBatch.id_base && input_id <= inputBatch.id_base + inputBatch.n_sent;
+    },
+
+    // the same wall clock as every other browser timestamp in a trace (arrival and shown times); performance.now
+    // drifts from it over a long-lived page and can pause while the machine sleeps
+    now: function() {
+        return Date.now() / 1000;
+    },
+
+    push: function(kind, args) {
+        inputBatch.n_sent += 1;
+        inputBatch.events.push([kind, inputBatch.now(), inputBatch.id_base + inputBatch.n_sent].concat(args));
+        if (inputBatch.scheduled) return;
+
+        inputBatch.scheduled = true;
+        if (inputBatch.interval > 0) window.setTimeout(inputBatch.flush, inputBatch.interval);
+        else window.requestAnimationFrame(inputBatch.flush);
+    },
+
+    flush: function() {
+        inputBatch.scheduled = false;
+        var events = inputBatch.events;
+        if (events.length === 0) return;
+        inputBatch.events = [];
+
+        if (inputSocket.send(["b", events])) return;
+        $.ajax({url: "/input/batch", type: "POST", contentType: "application/json", data: JSON.stringify(events)});
+    },
+};
@@ -0,0 +1,26 @@
+// All input events over one persistent websocket to /input/ws, as compact JSON arrays:
+//     ["m", x, y]   ["c", button]   ["k", key, shiftKey, ctrlKey, altKey]   or a batch: ["b", [[kind, t, id, *args], ...]]
+// send() returns false while the socket is not open, and the caller falls back to an AJAX POST.
+
+var inputSocket = {
+    ws: null,
+    retrySleepTime: 1000,
+
+    open: function() {
+        var proto = (window.location.protocol === "https:") ? "wss://" : "ws://";
+        var ws = new WebSocket(proto + window.location.host + "/input/ws");
+        ws.onclose = function() { window.setTimeout(inputSocket.open, inputSocket.retrySleepTime); };
+        inputSocket.ws = ws;
+    },
+
+    send: function(event) {
+        var ws = inputSocket.ws;
+        if (ws === null || ws.readyState !== WebSocket.OPEN) return false;
+        ws.send(JSON.stringify(event));
+        return true;
+    },
+};
+
+$( function() {
+    inputSocket.open();
+} );
@@ -2,12 +2,12 @@ $( function() {
 
     document.addEventListener('mousemove', handleMouseMove);
     function handleMouseMove(event) {
-        $.ajax({url: "/mouse/move", type: "POST", dataType: "json", data:{x:event.pageX, y:event.pageY}});
+        inputBatch.push("m", [event.pageX, event.pageY]);
     }
 
     document.addEventListener('mousedown', handleMouseDown);
     function handleMouseDown(event) {
-        $.ajax({url: "/mouse/click", type: "POST", dataType: "json", data:{button:event.button}});
+        inputBatch.push("c", [event.button]);
     }
 
 } );
\ No newline at end of file
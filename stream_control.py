@@ -0,0 +1,137 @@
+from encoders import get_encoder, ViewportEncoder
+
+
+
+###########################################################################################
+###########################################################################################
+###### Adaptive Quality / Resolution Control
+
+## (max quality, scale) per level, best first. Quality drops first, then resolution
+LEVELS = [
+    (95, 1.0),
+    (80, 1.0),
+    (65, 1.0),
+    (50, 1.0),
+    (50, 0.75),
+    (50, 0.5),
+    (40, 0.5),
+    (40, 0.33),
+]
+
+def write_buffer_size(handler):
+    ## bytes the connection's IOStream is still holding because the socket would not take them
+    stream = handler.request.connection.stream
+    buffer = getattr(stream, '_write_buffer', None)
+    if buffer is None: return 0
+    return len(buffer)
+
+
+class AdaptiveController:
+    ''' Per-connection controller stepping a stream down the LEVELS ladder when its client falls behind, and back up
+        when it recovers.
+
+        After each frame the stream reports how long its flush took and how many bytes the socket left buffered.
+        n_down consecutive late frames move one level down; n_up consecutive on-time frames move one level up, so a
+        brief stall does not thrash quality. encoder() maps the base encoder to the current level; lossless encoders
+        only change resolution.
+    '''
+
+    def __init__(self, latency_budget=0.05, max_buffered=1 << 20, n_down=2, n_up=30, levels=LEVELS):
+        self.latency_budget = latency_budget
+        self.max_buffered = max_buffered
+        self.n_down = n_down
+        self.n_up = n_up
+        self.levels = levels
+
+        self.level = 0
+        self.n_late = 0
+        self.n_on_time = 0
+
+    def update(self, flush_latency, buffered):
+        behind = (flush_latency > self.latency_budget) or (buffered > self.max_buffered)
+
+        if behind:
+            self.n_late += 1
+            self.n_on_time = 0
+            if self.n_late >= self.n_down and self.level < len(self.levels) - 1:
+                self.level += 1
+                self.n_late = 0
+        else:
+            self.n_on_time += 1
+            self.n_late = 0
+            if self.n_on_time >= self.n_up and self.level > 0:
+                self.level -= 1
+                self.n_on_time = 0
+
+    def encoder(self, base):
+        max_quality, scale = self.levels[self.level]
+        if self.level == 0: return base
+
+        quality = min(base.quality, max_quality) if base.lossy else base.quality
+        return get_encoder(base.name, quality, scale * getattr(base, 'scale', 1.0))
+
+
+
+###########################################################################################
+###########################################################################################
+###### Client Viewport
+
+class Viewport:
+    ''' What a client actually displays: its canvas size in CSS pixels, the device pixel ratio, and optionally the
+        region of the frame (y0, x0, y1, x1, in frame pixels) it shows.
+
+        encoder() wraps a stream's encoder so the frame is cropped to the region and downscaled to the canvas's device
+        pixels before encoding; frames are never upscaled. An adaptive scale on the stream's encoder applies on top of
+        the viewport size. Clients with the same viewport get the same encode key, so they still share one encode.
+    '''
+
+    def __init__(self, w, h, dpr=1.0, roi=None):
+        if w <= 0 or h <= 0 or dpr <= 0: raise ValueError('viewport size and dpr must be positive')
+        if roi is not None:
+            roi = tuple( int(v) for v in roi )
+            if len(roi) != 4 or roi[0] < 0 or roi[1] < 0 or roi[2] <= roi[0] or roi[3] <= roi[1]:
+                raise ValueError('roi must be y0,x0,y1,x1 with y0 < y1 and x0 < x1')
+
+        self.w = int(w)
+        self.h = int(h)
+        self.dpr = float(dpr)
+        self.roi = roi
+        self._encoders = dict()
+
+    @classmethod
+    def from_args(cls, w, h, dpr=None, roi=None):
+        ## from request arguments or a client message; None if the client did not send a size
+        if w is None or h is None: return None
+        if isinstance(roi, str): roi = roi.split(',') if roi else None
+        return cls(float(w), float(h), 1.0 if dpr is None else float(dpr), roi)
+
+    def region(self, frame_size):
+        ## (y0, x0, y1, x1) of the frame shown, clipped to the frame
+        fh, fw = frame_size[:2]
+        if self.roi is None: return (0, 0, fh, fw)
+        y0, x0, y1, x1 = self.roi
+        y0, x0 = min(y0, fh - 1), min(x0, fw - 1)
+        return (y0, x0, min(max(y1, y0 + 1), fh), min(max(x1, x0 + 1), fw))
+
+    def out_size(self, frame_size, scale=1.0):
+        y0, x0, y1, x1 = self.region(frame_size)
+        h = min(y1 - y0, round(self.h * self.dpr))
+        w = min(x1 - x0, round(self.w * self.dpr))
+        return ( max(1, round(h * scale)), max(1, round(w * scale)) )
+
+    def encoder(self, base, frame_size):
+        ## base may already be scaled by an AdaptiveController; its inner encoder is wrapped instead
+        inner = getattr(base, 'encoder', base)
+        size = self.out_size(frame_size, getattr(base, 'scale', 1.0))
+
+        region = self.region(frame_size)
+        roi = None if region == (0, 0, *frame_size[:2]) else region
+        if roi is None and size == tuple(frame_size[:2]): return inner
+
+        key = (inner.key, size, roi)
+        encoder = self._encoders.get(key)
+        if encoder is None:
+            ## sizes change while a window is resized; keep only the ones in use
+            if len(self._encoders) > 8: self._encoders.clear()
+            encoder = self._encoders[key] = ViewportEncoder(inner, size, roi)
+        return encoder
@@ -0,0 +1,66 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+
+from encoders import StripJpegEncoder, jpeg_scan, join_jpeg_strips
+
+
+
+def make_frame(h, w, seed=0):
+    ## smooth gradients plus noise, so every strip has both flat and busy blocks
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w]
+    frame = np.stack([ x * 255 // max(1, w - 1), y * 255 // max(1, h - 1), (x + y) % 256 ], axis=2)
+    frame = frame + rng.integers(-24, 25, size=frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def decode(jpg):
+    image = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
+    assert image is not None
+    return image
+
+def encode_strips(encoder, frame, n_strips):
+    height = frame.shape[0]
+    strip_h = -(-height // n_strips)
+    strip_h = -(-strip_h // encoder.STRIP_ALIGN) * encoder.STRIP_ALIGN
+    return [ encoder.encode_strip(frame[y:y+strip_h]) for y in range(0, height, strip_h) ]
+
+
+@pytest.mark.parametrize('h, w', [(1081, 1917), (17, 33)])
+@pytest.mark.parametrize('n_strips', [2, 3, 7, 8, 9, 16, 33, 64])
+def test_joined_strips_decode_like_single_pass(h, w, n_strips):
+    encoder = StripJpegEncoder(quality=90)
+    frame = cv2.cvtColor(make_frame(h, w), cv2.COLOR_RGB2BGR)
+
+    strips = encode_strips(encoder, frame, n_strips)
+    if len(strips) < 2: pytest.skip('frame fits in one strip')
+
+    joined = decode(join_jpeg_strips(strips, h))
+    single = decode(encoder.encode_strip(frame))
+
+    assert joined.shape == (h, w, 3)
+    ## same blocks, same tables and the same edge padding, so only decoder rounding may differ
+    assert np.abs(joined.astype(int) - single.astype(int)).max() <= 2
+
+
+@pytest.mark.parametrize('h, w', [(1081, 1917), (17, 33)])
+def test_strip_encoder_output(h, w):
+    frame = make_frame(h, w, seed=1)
+    image = decode(StripJpegEncoder(quality=90, n_strips=4).encode(frame))
+    single = decode(StripJpegEncoder(quality=90, n_strips=1).encode(frame))
+    assert np.abs(image.astype(int) - single.astype(int)).max() <= 2
+
+
+def test_jpeg_scan():
+    jpg = StripJpegEncoder(quality=90).encode_strip(make_frame(32, 48))
+    sof, sos, data = jpeg_scan(jpg)
+
+    assert jpg[sof:sof+2] == b'\xff\xc0'
+    assert jpg[sos:sos+2] == b'\xff\xda'
+    assert sof < sos < data < len(jpg)
+    assert int.from_bytes(jpg[sof+5:sof+7], 'big') == 32
+    assert int.from_bytes(jpg[sof+7:sof+9], 'big') == 48
+
+    with pytest.raises(ValueError):
+        jpeg_scan(join_jpeg_strips([jpg, jpg], 64))
@@ -0,0 +1,151 @@
+import functools
+import struct
+import time
+
+import cv2
+import numpy as np
+
+from encoders import blob_view
+
+from tornado.ioloop import IOLoop
+
+
+
+###########################################################################################
+###########################################################################################
+###### Delta-Tile Frame Transport
+## The frame is cut into fixed TILE x TILE tiles (edge tiles are smaller). Each client gets only the tiles that changed
+## since the last frame it was sent, each as its own small JPEG, and composites them onto a persistent canvas.
+## A full keyframe is sent to new clients and every KEY_INTERVAL packets, so a client that missed anything resyncs.
+##
+## Packet layout, little-endian:
+##     header:   magic b'TILE' | seq u32 | n_tiles u32 | frame_h u16 | frame_w u16 | keyframe u8 | pad u8
+##     n_tiles x tile header:   y u16 | x u16 | h u16 | w u16 | nbytes u32
+##     tile JPEGs, concatenated in tile-header order
+
+TILE = 64
+KEY_INTERVAL = 120
+CLIENT_TIMEOUT = 30.0
+
+PACKET_HEAD = struct.Struct('<4sIIHHBx')
+TILE_HEAD = struct.Struct('<HHHHI')
+MAGIC = b'TILE'
+
+def changed_tiles(frame, prev, tile=TILE):
+    ## (ty, tx) of every tile whose pixels differ between frame and prev
+    diff = np.any(frame != prev, axis=2)
+    rows = np.logical_or.reduceat(diff, np.arange(0, diff.shape[0], tile), axis=0)
+    grid = np.logical_or.reduceat(rows, np.arange(0, diff.shape[1], tile), axis=1)
+    return list(zip(*np.nonzero(grid)))
+
+def diff_tiles(frame_hub, entry, prev, prev_seq, tile=TILE):
+    ''' Awaitable of changed_tiles(entry.frame, prev), where prev is the frame sent as prev_seq. The diff runs on the
+        hub's encoder worker, off the IOLoop, and is cached on the entry so clients going from the same frame to this
+        one share it.
+    '''
+    key = ('diff', tile, prev_seq)
+    future = entry.encoded.get(key)
+    if future is None:
+        future = IOLoop.current().run_in_executor(frame_hub.encode_exec, functools.partial(changed_tiles, entry.frame, prev, tile))
+        entry.encoded[key] = future
+    return future
+
+def all_tiles(frame_size, tile=TILE):
+    n_ty = (frame_size[0] + tile - 1) // tile
+    n_tx = (frame_size[1] + tile - 1) // tile
+    return [(ty, tx) for ty in range(n_ty) for tx in range(n_tx)]
+
+def tile_rect(frame_size, ty, tx, tile=TILE):
+    y, x = ty * tile, tx * tile
+    return y, x, min(tile, frame_size[0] - y), min(tile, frame_size[1] - x)
+
+def encode_tile_list(frame, tiles, tile, quality):
+    ## runs on the hub's encoder worker; frames are RGB, cv2 wants BGR. returns the blobs and when the job finished
+    blobs = list()
+    for ty, tx in tiles:
+        y, x, h, w = tile_rect(frame.shape, ty, tx, tile)
+        patch = cv2.cvtColor(frame[y:y+h, x:x+w], cv2.COLOR_RGB2BGR)
+        success, blob = cv2.imencode('.jpg', patch, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        blobs.append(blob_view(blob) if success else b'')
+    return blobs, time.time()
+
+async def encode_tiles(frame_hub, entry, tiles, tile=TILE, quality=85):
+    ''' Encoded JPEG of each (ty, tx) in tiles, cached on the hub entry so clients needing the same tile of the
+        same frame share one encode. Tiles not cached yet are encoded together in one job on the hub's encoder worker.
+
+        Returns (blobs, t_encoded): t_encoded is when the last of the jobs holding these tiles finished, or now if
+        tiles is empty.
+    '''
+    missing = [ (ty, tx) for ty, tx in tiles if ('tile', tile, quality, ty, tx) not in entry.encoded ]
+    if missing:
+        job = IOLoop.current().run_in_executor(frame_hub.encode_exec, functools.partial(encode_tile_list, entry.frame, missing, tile, quality))
+        for i, (ty, tx) in enumerate(missing):
+            entry.encoded[('tile', tile, quality, ty, tx)] = (job, i)
+
+    blobs = list()
+    t_encoded = None
+    for ty, tx in tiles:
+        job, i = entry.encoded[('tile', tile, quality, ty, tx)]
+        job_blobs, t_done = await job
+        blobs.append(job_blobs[i])
+        t_encoded = t_done if t_encoded is None else max(t_encoded, t_done)
+
+    if t_encoded is None: t_encoded = time.time()
+    return blobs, t_encoded
+
+def pack_tiles(seq, frame_size, tiles, blobs, keyframe, tile=TILE):
+    parts = [ PACKET_HEAD.pack(MAGIC, seq, len(tiles), frame_size[0], frame_size[1], int(keyframe)) ]
+    for (ty, tx), blob in zip(tiles, blobs):
+        parts.append( TILE_HEAD.pack(*tile_rect(frame_size, ty, tx, tile), len(blob)) )
+    parts.extend(blobs)
+    return b''.join(parts)
+
+
+class TileClient:
+    ## what one browser was last sent; clients poll with separate requests, so this lives between them
+    __slots__ = ('last_frame', 'last_seq', 'n_since_key', 'last_seen', 'stats')
+
+    def __init__(self, stats=None):
+        self.stats = stats
+        self.last_frame = None
+        self.last_seq = -1
+        self.n_since_key = 0
+        self.last_seen = time.monotonic()
+
+
+class TileClients:
+    def __init__(self, key_interval=KEY_INTERVAL, timeout=CLIENT_TIMEOUT):
+        self.clients = dict()
+        self.key_interval = key_interval
+        self.timeout = timeout
+
+    def get(self, frame_hub, client_id, peer=None):
+        now = time.monotonic()
+        for stale in [cid for cid, c in self.clients.items() if now - c.last_seen > self.timeout]:
+            frame_hub.unsubscribe(self.clients.pop(stale).stats)
+
+        client = self.clients.get(client_id)
+        if client is None:
+            client = self.clients[client_id] = TileClient(frame_hub.subscribe('tiles', peer))
+        client.last_seen = now
+        return client
+
+    async def packet(self, frame_hub, client, entry, resync=False, tile=TILE, quality=85):
+        ## builds the packet taking client from its last frame to entry.frame, and records entry as sent.
+        ## returns (packet, t_encoded), t_encoded as from encode_tiles
+        frame = entry.frame
+        keyframe = resync or client.last_frame is None or client.n_since_key >= self.key_interval \
+                   or client.last_frame.shape != frame.shape
+
+        if keyframe: tiles = all_tiles(frame.shape, tile)
+        else: tiles = await diff_tiles(frame_hub, entry, client.last_frame, client.last_seq, tile)
+
+        blobs, t_encoded = await encode_tiles(frame_hub, entry, tiles, tile, quality)
+        client.stats.count(max(client.last_seq, 0), entry.seq)
+
+        ## hub frames are never written after publish, so keeping a reference is enough
+        client.last_frame = frame
+        client.last_seq = entry.seq
+        client.n_since_key = 0 if keyframe else client.n_since_key + 1
+
+        return pack_tiles(entry.seq, frame.shape, tiles, blobs, keyframe, tile), t_encoded